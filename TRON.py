@@ -1,9 +1,28 @@
+from time import perf_counter
+
+IMPORT_START = perf_counter()
+
 import pygame
 import sys
+import argparse
+import colorsys
+import functools
+import gc
 import json
+import os
+import queue
 import random
+import struct
+import tempfile
+import threading
+import zlib
+from bisect import bisect_right
+from array import array
+from collections import OrderedDict
 from enum import Enum
-from time import time
+from time import monotonic, strftime, time
+
+IMPORT_END = perf_counter()
 
 
 class Direction(Enum):
@@ -12,28 +31,285 @@ class Direction(Enum):
     LEFT = (-1, 0)
     RIGHT = (1, 0)
 
+
+COLLISION_CELL = 5
+AI_BUDGET_MS = 4.0
+AI_LOOKAHEAD_TICKS = 10
+AI_WORKER_BUDGET_MS = 12.0
+TICK_RATE = 60
+MAX_CATCH_UP_TICKS = 5
+PROFILE_FRAMES = 600
+PROFILE_HUD_REFRESH = 0.25
+PROFILE_HISTOGRAM_MS = 40
+MEMORY_GROWTH_LIMIT = 256 * 1024
+SETTINGS_PATH = "settings.json"
+SETTINGS_DELAY = 0.5
+SOUND_FILES = {"collision": "collision.wav", "victory": "victory.wav"}
+
+REPLAY_MAGIC = b"TRNR"
+REPLAY_VERSION = 2
+REPLAY_HEADER = struct.Struct("<4sBHHBQB")
+REPLAY_SEAT = struct.Struct("<B3B")
+REPLAY_INDEX_ENTRY = struct.Struct("<III")
+REPLAY_FOOTER = struct.Struct("<I4s")
+REPLAY_INDEX_MAGIC = b"TRNI"
+REPLAY_KEYFRAME_INTERVAL = 300
+SIM_STATE = struct.Struct("<IBB")
+CYCLE_STATE = struct.Struct("<iiiiiBBBI")
+REPLAY_SPEED = 0xFE
+REPLAY_END = 0xFF
+DIFFICULTY_CODES = [None, "easy", "medium", "hard", "expert"]
+DIRECTION_CODES = list(Direction)
+FREE_CELL_TABLE = bytes([ord("1")] + [ord("0")] * 255)
+
+
+class OccupancyGrid:
+    def __init__(self, width, height, cell=COLLISION_CELL):
+        self.width = width
+        self.height = height
+        self.cell = cell
+        self.cols = width // cell + 1
+        self.rows = height // cell + 1
+        self.cells = bytearray(self.cols * self.rows)
+        self.first_col, self.last_col = -(-10 // cell), (width - 10) // cell
+        self.first_row, self.last_row = -(-10 // cell), (height - 10) // cell
+        self.interiors = {}
+        # undo journal of (target, key, old value) writes, kept while snapshots are taken;
+        # journal_base counts the entries already trimmed from its front
+        self.journal = None
+        self.journal_base = 0
+
+        # free run length tables: how many empty cells lie beyond each cell in each direction
+        longest = max(self.cols, self.rows)
+        self.ascending = array("H", range(longest))
+        self.descending = array("H", range(longest - 1, -1, -1))
+        self.reset_runs()
+
+    def reset_runs(self):
+        # builds the free-run tables from the cells in one pass over every row and column
+        cells, cols = self.cells, self.cols
+        self.runs = {direction: array("H", bytes(2 * len(cells))) for direction in Direction}
+        span = self.last_col - self.first_col + 1
+        for row in range(self.first_row, self.last_row + 1):
+            start = row * cols + self.first_col
+            before, after = self.line_runs(cells[start:start + span])
+            self.runs[Direction.LEFT][start:start + span] = before
+            self.runs[Direction.RIGHT][start:start + span] = after
+        for col in range(self.first_col, self.last_col + 1):
+            start = self.first_row * cols + col
+            stop = self.last_row * cols + col + 1
+            before, after = self.line_runs(cells[start:stop:cols])
+            self.runs[Direction.UP][start:stop:cols] = before
+            self.runs[Direction.DOWN][start:stop:cols] = after
+
+    def line_runs(self, line):
+        # how many empty cells lie before and after each cell of a line, between occupied
+        # cells and the line's ends; occupied cells keep no runs. The runs before the cells of
+        # each gap are the start of the ascending table, joined with a zero for each occupied
+        # cell; the runs after them are the same for the line read backwards
+        ascending = self.ascending.tobytes()
+        gaps = [2 * len(gap) for gap in bytes(line).translate(FREE_CELL_TABLE).split(b"0")]
+        before, after = array("H"), array("H")
+        before.frombytes(b"\0\0".join([ascending[:n] for n in gaps]))
+        after.frombytes(b"\0\0".join([ascending[:n] for n in reversed(gaps)]))
+        after.reverse()
+        return before, after
+
+    def load(self, cells):
+        # replaces the grid contents with cells, rebuilding the free-run tables; earlier
+        # snapshots can no longer be restored
+        self.journal = None
+        self.cells[:] = cells
+        self.reset_runs()
+
+    def index(self, x, y):
+        return int(y) // self.cell * self.cols + int(x) // self.cell
+
+    def in_bounds(self, x, y):
+        return 0 <= x < self.cols * self.cell and 0 <= y < self.rows * self.cell
+
+    def is_occupied(self, x, y):
+        return self.in_bounds(x, y) and self.cells[self.index(x, y)] != 0
+
+    def free_run(self, x, y, direction):
+        # empty cells between (x, y) and the nearest trail or wall, in O(1)
+        return self.runs[direction][self.index(x, y)]
+
+    def lattice(self, x, y, step):
+        # the cells a cycle at (x, y) can stop on, step cells apart in both directions, as
+        # (free, width): free has one bit per lattice cell, set when it is empty and inside the
+        # walls, row by row with a blocked bit closing each row so shifts cannot wrap
+        col, row = int(x) // self.cell % step, int(y) // self.cell % step
+        key = (col, row, step)
+        if key not in self.interiors:
+            outside = bytearray(b"\1" * len(self.cells))
+            span = self.last_col - self.first_col + 1
+            for i in range(self.first_row, self.last_row + 1):
+                start = i * self.cols + self.first_col
+                outside[start:start + span] = bytes(span)
+            self.interiors[key] = self.sample(outside, col, row, step)
+        return self.sample(self.cells, col, row, step) & self.interiors[key], (self.cols - col - 1) // step + 2
+
+    def sample(self, cells, col, row, step):
+        # cells may be a view of shared memory, whose strided slices cannot be joined
+        cells, cols = bytes(cells), self.cols
+        rows = b"\1".join(cells[i * cols + col:(i + 1) * cols:step] for i in range(row, self.rows, step))
+        return int(rows.translate(FREE_CELL_TABLE)[::-1], 2)
+
+    def mark(self, col, row, owner=1):
+        # returns True when the cell was empty
+        i = row * self.cols + col
+        if self.cells[i]:
+            return False
+        write = self.write
+        write(self.cells, i, owner)
+        if not (self.first_col <= col <= self.last_col and self.first_row <= row <= self.last_row):
+            return True
+        # the new obstacle cuts the runs of the free cells on each side of it
+        runs, cols = self.runs, self.cols
+        n = runs[Direction.LEFT][i]
+        if n:
+            write(runs[Direction.RIGHT], slice(i - n, i), self.descending[-n:])
+        n = runs[Direction.RIGHT][i]
+        if n:
+            write(runs[Direction.LEFT], slice(i + 1, i + 1 + n), self.ascending[:n])
+        n = runs[Direction.UP][i]
+        if n:
+            write(runs[Direction.DOWN], slice(i - n * cols, i, cols), self.descending[-n:])
+        n = runs[Direction.DOWN][i]
+        if n:
+            write(runs[Direction.UP], slice(i + cols, i + (n + 1) * cols, cols), self.ascending[:n])
+        # occupied cells keep no runs, so the tables depend only on which cells are set
+        for run in runs.values():
+            write(run, i, 0)
+        return True
+
+    def write(self, target, key, value):
+        if self.journal is not None:
+            self.journal.append((target, key, target[key]))
+        target[key] = value
+
+    def undo(self, position):
+        # rolls the grid back to when the journal held position entries in total
+        journal = self.journal
+        keep = position - self.journal_base
+        if journal is None or not 0 <= keep <= len(journal):
+            raise ValueError("snapshot is no longer in the undo journal")
+        for target, key, value in reversed(journal[keep:]):
+            target[key] = value
+        del journal[keep:]
+
+    def sweep(self, x0, y0, x1, y1):
+        # (col, row) of every cell on the way from (x0, y0) to (x1, y1), both ends included
+        col, row = int(x0) // self.cell, int(y0) // self.cell
+        end_col, end_row = int(x1) // self.cell, int(y1) // self.cell
+        step_col = (end_col > col) - (end_col < col)
+        step_row = (end_row > row) - (end_row < row)
+        cells = [(col, row)]
+        while (col, row) != (end_col, end_row):
+            if col != end_col:
+                col += step_col
+            else:
+                row += step_row
+            cells.append((col, row))
+        return cells
+
+    def mark_segment(self, x0, y0, x1, y1, owner=1):
+        # marks every cell from (x0, y0) up to, but not including, the cell of (x1, y1);
+        # returns the indices of the cells that were empty before
+        marked = set()
+        for col, row in self.sweep(x0, y0, x1, y1)[:-1]:
+            if 0 <= col < self.cols and 0 <= row < self.rows and self.mark(col, row, owner):
+                marked.add(row * self.cols + col)
+        return marked
+
+def crossing_index(cycles):
+    # shared collision index for one tick: cell -> the cycle whose move crossed or left it,
+    # or None when several did
+    index = {}
+    for cycle in cycles:
+        if cycle.origin is None:
+            continue
+        for i in (cycle.origin, *cycle.path):
+            index[i] = cycle if index.get(i, cycle) is cycle else None
+    return index
+
+
+class Trail:
+    # polyline of a cycle's path: one vertex per turn plus the current head, which moves in place
+    def __init__(self, x, y):
+        self.vertices = array("i", (x, y, x, y))
+
+    def __len__(self):
+        return len(self.vertices) // 2
+
+    def __getitem__(self, i):
+        i = range(len(self))[i]
+        return self.vertices[2 * i], self.vertices[2 * i + 1]
+
+    @property
+    def head(self):
+        return self[-1]
+
+    def move_head(self, x, y):
+        self.vertices[-2:] = array("i", (x, y))
+
+    def turn(self):
+        # pins the head as a corner; a second turn before the head moves reuses the same corner
+        if self.vertices[-4:-2] != self.vertices[-2:]:
+            self.vertices.extend(self.vertices[-2:])
+
+    def points(self, start=0, stop=None):
+        vertices = self.vertices
+        stop = len(self) if stop is None else stop
+        return [(vertices[i], vertices[i + 1]) for i in range(2 * start, 2 * stop, 2)]
+
+
 #BASICALLY EVERYTHING
 class LightCycle:
-    def __init__(self, x, y, color, direction, key_controls, player_name, speed, is_ai=False):
+    def __init__(self, x, y, color, direction, key_controls, player_name, speed, is_ai=False, grid=None):
         self.x = x
         self.y = y
         self.color = color
         self.direction = direction
-        self.trail = [(x, y, time())]
+        self.trail = Trail(x, y)
+        # position before the latest move and the trail vertex that move started from
+        self.last_x = x
+        self.last_y = y
+        self.last_vertex = len(self.trail) - 1
         self.key_controls = key_controls
         self.player_name = player_name
         self.speed = speed
         self.alive = True
         self.is_ai = is_ai
         self.player_directions = []
+        self.grid = grid
+        # cells crossed by the latest move: its starting cell, those after it, and those it marked
+        self.origin = None
+        self.path = set()
+        self.marked = set()
+        # every direction change accepted since the latest move, in order, for replays
+        self.turns = []
         #MOVEMENTS
     def move(self):
+        self.turns.clear()
         if not self.alive:
+            self.origin = None
+            self.path = set()
             return
         dx, dy = self.direction.value
+        prev_x, prev_y = self.x, self.y
+        self.last_x, self.last_y = prev_x, prev_y
+        self.last_vertex = len(self.trail) - 1
         self.x += dx * self.speed
         self.y += dy * self.speed
-        self.trail.append((self.x, self.y, time()))
+        self.trail.move_head(self.x, self.y)
+        if self.grid is not None:
+            grid = self.grid
+            self.origin = grid.index(prev_x, prev_y)
+            self.path = {row * grid.cols + col for col, row in grid.sweep(prev_x, prev_y, self.x, self.y)[1:]
+                         if 0 <= col < grid.cols and 0 <= row < grid.rows}
+            self.marked = grid.mark_segment(prev_x, prev_y, self.x, self.y)
 
     def change_direction(self, new_direction):
         if not self.alive:
@@ -41,55 +317,53 @@ class LightCycle:
         current_dx, current_dy = self.direction.value
         new_dx, new_dy = new_direction.value
         if (current_dx, current_dy) != (-new_dx, -new_dy):
+            if new_direction != self.direction:
+                self.trail.turn()
+                self.turns.append(new_direction)
             self.direction = new_direction
         #BOT MLVEMENTS
-    def ai_move(self, other_trail, screen_width, screen_height, difficulty, player_directions):
+    def ai_move(self, others, screen_width, screen_height, difficulty, player_directions, rng=random,
+                budget_ms=AI_BUDGET_MS):
         if not self.alive or not self.is_ai:
             return
 
         possible_directions = [Direction.UP, Direction.DOWN, Direction.LEFT, Direction.RIGHT]
+        if difficulty == "expert":
+            best_direction = self.choose_territory_direction(others, budget_ms)
+            if best_direction is not None:
+                self.change_direction(best_direction)
+                return
+            # no safe move, or no time to search: play as hard does
+            difficulty = "hard"
+
         safe_directions = []
         current_dx, current_dy = self.direction.value
 
         for direction in possible_directions:
             dx, dy = direction.value
-            if (dx, dy) == (-current_dx, -dy):
+            if (dx, dy) == (-current_dx, -current_dy):
                 continue
-            new_x = self.x + dx * self.speed * 10
-            new_y = self.y + dy * self.speed * 10
-            if (new_x >= 10 and new_x <= screen_width - 10 and
-                    new_y >= 10 and new_y <= screen_height - 10):
-                safe = True
-                recent_trail = other_trail[-200:] if len(other_trail) > 200 else other_trail
-                for segment in recent_trail + self.trail[-200:-10]:
-                    if abs(new_x - segment[0]) < 15 and abs(new_y - segment[1]) < 15:
-                        safe = False
-                        break
-                if safe:
-                    safe_directions.append(direction)
+            if self.grid.free_run(self.x, self.y, direction) * self.grid.cell >= self.speed * AI_LOOKAHEAD_TICKS:
+                safe_directions.append(direction)
 
         if safe_directions:
             if difficulty == "hard":
-                best_direction = self.choose_best_direction(
-                    safe_directions, other_trail, screen_width, screen_height, player_directions)
+                best_direction = self.choose_best_direction(safe_directions, player_directions)
                 self.change_direction(best_direction)
             elif difficulty == "medium":
-                self.change_direction(random.choice(safe_directions))
+                self.change_direction(rng.choice(safe_directions))
             else:
-                if random.random() < 0.3:
-                    self.change_direction(random.choice(safe_directions))
+                if rng.random() < 0.3:
+                    self.change_direction(rng.choice(safe_directions))
         elif difficulty != "easy":
-            self.change_direction(random.choice(possible_directions))
+            self.change_direction(rng.choice(possible_directions))
 
-    def choose_best_direction(self, safe_directions, other_trail, screen_width, screen_height, player_directions):
+    def choose_best_direction(self, safe_directions, player_directions):
         best_direction = safe_directions[0]
         max_space = -1
 
-        recent_trail = other_trail[-200:] if len(other_trail) > 200 else other_trail
         for direction in safe_directions:
             dx, dy = direction.value
-            steps = 0
-            x, y = self.x, self.y
             score = 0
             if player_directions:
                 player_dx, player_dy = player_directions[-1].value
@@ -97,18 +371,7 @@ class LightCycle:
                     score += 10
                 elif (dx, dy) == (-player_dx, -player_dy):
                     score -= 5
-            while (x >= 10 and x <= screen_width - 10 and
-                   y >= 10 and y <= screen_height - 10):
-                x += dx * self.speed
-                y += dy * self.speed
-                steps += 1
-                for segment in recent_trail + self.trail[-200:-10]:
-                    if abs(x - segment[0]) < 15 and abs(y - segment[1]) < 15:
-                        steps -= 1
-                        break
-                else:
-                    continue
-                break
+            steps = self.grid.free_run(self.x, self.y, direction) * self.grid.cell // self.speed
             total_score = steps + score
             if total_score > max_space:
                 max_space = total_score
@@ -116,45 +379,1087 @@ class LightCycle:
 
         return best_direction
 
+    def choose_safe_direction(self):
+        # cheap fallback: keep going while the next step is clear, otherwise take the longest free run
+        if self.grid.free_run(self.x, self.y, self.direction) * self.grid.cell >= self.speed:
+            return self.direction
+        current_dx, current_dy = self.direction.value
+        directions = [d for d in Direction if d.value != (-current_dx, -current_dy)]
+        return max(directions, key=lambda d: self.grid.free_run(self.x, self.y, d))
+
+    def choose_territory_direction(self, others, budget_ms):
+        # Voronoi flood fill over the lattice of cells the cycles stop on each tick: every
+        # candidate move races the opponents outward one tick of movement per round, and the
+        # move that claims the most cells wins. Rounds stop once the time budget, which covers
+        # the setup too, is spent, so deeper searches only refine the answer. Returns None when
+        # no move is safe, or when the budget ran out before the search saw AI_LOOKAHEAD_TICKS ahead
+        deadline = perf_counter() + budget_ms / 1000
+        grid = self.grid
+        step = max(self.speed // grid.cell, 1)
+        free, width = grid.lattice(self.x, self.y, step)
+        first_col, first_row = int(self.x) // grid.cell % step, int(self.y) // grid.cell % step
+
+        def node(x, y):
+            col, row = (int(x) // grid.cell - first_col) // step, (int(y) // grid.cell - first_row) // step
+            return 1 << (row * width + col) if col >= 0 and row >= 0 else 0
+
+        opponents = 0
+        for other in others:
+            if other.alive and grid.in_bounds(other.x, other.y):
+                opponents |= node(other.x, other.y)
+        # lattice cells an opponent can reach this tick; ending a move there risks a head-on
+        danger = opponents | opponents << 1 | opponents >> 1 | opponents << width | opponents >> width
+
+        searches = []
+        current_dx, current_dy = self.direction.value
+        for direction in Direction:
+            dx, dy = direction.value
+            if (dx, dy) == (-current_dx, -current_dy):
+                continue
+            run = grid.free_run(self.x, self.y, direction)
+            if run >= step:
+                head = node(self.x + dx * self.speed, self.y + dy * self.speed) & free
+                board = free & ~node(self.x, self.y)
+                walls = 4 - ((head << 1 | head >> 1 | head << width | head >> width) & board).bit_count()
+                # direction, board, my frontier, their frontier, claimed cells, score after each
+                # round, then what decides between moves besides the score: no head-on risk comes
+                # first, and equal scores go to the move along the most walls, which fills a
+                # closed-off region tightly, then to the longer free run
+                searches.append([direction, board, head, opponents & board, head | opponents, [0],
+                                 not head & danger, walls, run])
+        if not searches:
+            return None
+
+        # rounds go through every search in turn; one cut short by the deadline is not counted
+        rounds = 0
+        active = True
+        while active and perf_counter() < deadline:
+            active = False
+            for search in searches:
+                direction, board, mine, theirs, claimed, scores = search[:6]
+                mine = (mine << 1 | mine >> 1 | mine << width | mine >> width) & board & ~claimed
+                theirs = (theirs << 1 | theirs >> 1 | theirs << width | theirs >> width) & board & ~claimed
+                contested = mine & theirs
+                claimed |= mine | theirs
+                mine ^= contested
+                theirs ^= contested
+                search[2:5] = [mine, theirs, claimed]
+                scores.append(scores[-1] + mine.bit_count() - theirs.bit_count())
+                active |= bool(mine or theirs)
+                if perf_counter() > deadline:
+                    break
+            else:
+                rounds += 1
+        if active and rounds < AI_LOOKAHEAD_TICKS:
+            return None
+        best = max(searches, key=lambda search: (search[6], search[5][rounds], search[7], search[8]))
+        return best[0]
+
+    def draw_trail(self, surface, start=0, origin=None, settled=False):
+        # draws the trail from vertex start on, led in from origin when given; settled stops
+        # before the latest move. Returns the rect drawn, or None when there was nothing to draw
+        if settled:
+            points = self.trail.points(start, self.last_vertex) + [(self.last_x, self.last_y)]
+        else:
+            points = self.trail.points(start)
+        if origin is not None:
+            points.insert(0, origin)
+        if len(points) > 1:
+            return pygame.draw.lines(surface, self.color, False, points, 3)
+        return None
+
     def draw(self, screen):
         if not self.alive:
-            return
-        surface = pygame.Surface((screen.get_width(), screen.get_height()), pygame.SRCALPHA)
-        for i in range(len(self.trail) - 1):
-            pygame.draw.line(surface, self.color,
-                             (self.trail[i][0], self.trail[i][1]),
-                             (self.trail[i + 1][0], self.trail[i + 1][1]), 3)
-        screen.blit(surface, (0, 0))
-        pygame.draw.circle(screen, self.color, (int(self.x), int(self.y)), 5)
+            return None
+        return pygame.draw.circle(screen, self.color, (int(self.x), int(self.y)), 5)
             ##CRASH PHYSICS
-    def check_collision(self, other_trail, screen_width, screen_height):
+    def check_collision(self, screen_width, screen_height, others=(), crossings=None):
+        # crossings is a crossing_index shared by every cycle this tick; without one it is
+        # built from others
         if not self.alive:
             return False
-        head = (self.x, self.y)
         if (self.x < 10 or self.x > screen_width - 10 or
                 self.y < 10 or self.y > screen_height - 10):
             self.alive = False
             return True
-        recent_trail = other_trail[-200:] if len(other_trail) > 200 else other_trail
-        for segment in recent_trail + self.trail[-200:-10]:
-            if abs(self.x - segment[0]) < 5 and abs(self.y - segment[1]) < 5:
+        if self.grid is None:
+            return False
+        # swept test: every cell crossed since the last tick, so fast cycles cannot jump a trail.
+        # A cell is a hit when it was filled before this move, or when another cycle crossed it
+        # or set off from it in the same tick, which also covers head-on meetings
+        if crossings is None:
+            crossings = crossing_index([self, *others])
+        cells = self.grid.cells
+        for i in self.path:
+            if (cells[i] and i not in self.marked) or crossings.get(i, self) is not self:
                 self.alive = False
                 return True
         return False
 
 
+class Simulation:
+    def __init__(self, width, height, speed=10, difficulties=(None, "medium"),
+                 colors=((0, 255, 255), (255, 255, 0)), controls=({}, {}), ai_budget_ms=AI_BUDGET_MS,
+                 external_ai=(), seed=None):
+        # difficulties holds one AI difficulty per cycle, or None for a human player, and sets
+        # how many cycles the arena has; AI cycles listed in external_ai take their turns from
+        # step's actions instead. ai_budget_ms is the time all AI cycles share each tick.
+        # Missing colors and controls are filled in per seat
+        self.width = width
+        self.height = height
+        self.speed = speed
+        self.difficulties = list(difficulties)
+        self.ai_budget_ms = ai_budget_ms
+        self.external_ai = set(external_ai)
+        self.colors = colors
+        self.controls = controls
+        self.recorder = None
+        self.profiler = None
+        self.reset(seed)
+
+    def reset(self, seed=None):
+        self.seed = seed
+        self.rng = random.Random(seed)
+        self.tick = 0
+        self.grid = OccupancyGrid(self.width, self.height)
+        # seats alternate between a column a quarter in from the left, heading right, and one a
+        # quarter in from the right, heading left, in evenly spaced rows
+        seats = len(self.difficulties)
+        rows = (seats + 1) // 2
+        ai_seats = seats - self.difficulties.count(None)
+        self.cycles = []
+        for i, difficulty in enumerate(self.difficulties):
+            if difficulty is None:
+                name = f"Player {i + 1}"
+            else:
+                name = "AI" if ai_seats == 1 else f"AI {i + 1}"
+            self.cycles.append(LightCycle(
+                self.width // 4 if i % 2 == 0 else 3 * self.width // 4,
+                self.height * (i // 2 + 1) // (rows + 1),
+                self.seat_color(i), Direction.RIGHT if i % 2 == 0 else Direction.LEFT,
+                self.controls[i] if difficulty is None and i < len(self.controls) else {},
+                name, self.speed, is_ai=difficulty is not None, grid=self.grid))
+        self.game_over = False
+        self.winner = None
+        return self.state
+
+    def seat_color(self, i):
+        if i < len(self.colors):
+            return self.colors[i]
+        # evenly spread hues for seats without a configured color
+        r, g, b = colorsys.hsv_to_rgb(i * 0.618034 % 1, 1, 1)
+        return int(r * 255), int(g * 255), int(b * 255)
+
+    def step(self, actions=()):
+        # actions holds one Direction (or None) per cycle, applied before moving
+        if self.game_over:
+            return self.state
+        for cycle, action in zip(self.cycles, actions):
+            if action is not None:
+                cycle.change_direction(action)
+        if self.recorder is not None:
+            self.recorder.record(self)
+
+        for cycle in self.cycles:
+            cycle.move()
+
+        # one shared index of this tick's moves keeps collision checks linear in the cycle count
+        crossings = crossing_index(self.cycles)
+        crashed = False
+        for cycle in self.cycles:
+            crashed |= cycle.check_collision(self.width, self.height, crossings=crossings)
+        survivors = [cycle for cycle in self.cycles if cycle.alive]
+        if crashed and len(survivors) <= 1:
+            self.game_over = True
+            self.winner = survivors[0].player_name if survivors else "Draw"
+
+        # the surviving AIs pick their next turn; none do once the match is over, so its final
+        # state holds no turn that was never moved on and a replay can reproduce it exactly.
+        # They share one deadline, each getting an even split of the time left, so a seat that
+        # finishes early leaves its time to the seats after it
+        ai_start = perf_counter()
+        deadline = ai_start + self.ai_budget_ms / 1000
+        movers = [] if self.game_over else [
+            index for index, cycle in enumerate(self.cycles)
+            if self.difficulties[index] is not None and index not in self.external_ai and cycle.alive]
+        for turn, index in enumerate(movers):
+            cycle = self.cycles[index]
+            others = [other for other in survivors if other is not cycle]
+            nearest = min(others, key=lambda other: abs(other.x - cycle.x) + abs(other.y - cycle.y),
+                          default=None)
+            budget_ms = max(deadline - perf_counter(), 0.0) * 1000 / (len(movers) - turn)
+            cycle.ai_move(
+                others, self.width, self.height, self.difficulties[index],
+                nearest.player_directions if nearest else [], self.rng, budget_ms)
+        if self.profiler is not None:
+            self.profiler.record("ai", ai_start, perf_counter() - ai_start)
+        self.tick += 1
+        if self.recorder is not None:
+            self.recorder.stepped(self)
+        return self.state
+
+    def snapshot(self):
+        # cheap in-memory counterpart of save_state: scalar state is copied and the grid starts
+        # an undo journal, so restore costs O(changes since the snapshot). Trails only grow at the
+        # end, so they are cut back to their old length
+        if self.grid.journal is None:
+            self.grid.journal = []
+        return Snapshot(self)
+
+    def restore(self, snapshot):
+        # rolls back to snapshot; snapshots taken after it become invalid
+        if snapshot.grid is not self.grid:
+            raise ValueError("snapshot belongs to another match")
+        self.grid.undo(snapshot.position)
+        self.tick, self.speed, self.game_over, self.winner, rng_state = snapshot.state
+        self.rng.setstate(rng_state)
+        for cycle, state in zip(self.cycles, snapshot.cycles):
+            (cycle.x, cycle.y, cycle.direction, cycle.alive, cycle.speed,
+             cycle.last_x, cycle.last_y, cycle.last_vertex, length, head) = state
+            vertices = cycle.trail.vertices
+            del vertices[length:]
+            vertices[-2:] = head
+            cycle.origin = None
+            cycle.path = set()
+            cycle.marked = set()
+            cycle.turns = []
+        if self.recorder is not None and snapshot.recording is not None:
+            # the ticks after the snapshot will be recorded again as they are resimulated
+            self.recorder.rewind(snapshot.recording)
+
+    def trim(self, snapshot):
+        # drops undo history older than snapshot; snapshots taken before it become invalid
+        grid = self.grid
+        drop = snapshot.position - grid.journal_base
+        if grid.journal is not None and drop > 0:
+            del grid.journal[:drop]
+            grid.journal_base += drop
+
+    def step_codes(self, codes):
+        # step with netplay input codes, 0 for no turn or 1 + a DIRECTION_CODES index
+        return self.step([DIRECTION_CODES[code - 1] if code else None for code in codes])
+
+    def checksum(self):
+        # CRC of the state peers must agree on: every cycle and the occupancy grid
+        state = b"".join(CYCLE_STATE.pack(
+            cycle.x, cycle.y, cycle.last_x, cycle.last_y, cycle.last_vertex,
+            DIRECTION_CODES.index(cycle.direction), cycle.alive, cycle.speed, len(cycle.trail.vertices))
+            for cycle in self.cycles)
+        return zlib.crc32(self.grid.cells, zlib.crc32(state, self.tick))
+
+    def save_state(self):
+        # the full state between ticks, zlib compressed: tick, speed, every cycle with its trail,
+        # and the occupancy grid. Only valid while the match is running
+        data = bytearray(SIM_STATE.pack(self.tick, self.speed, len(self.cycles)))
+        for cycle in self.cycles:
+            data += CYCLE_STATE.pack(
+                cycle.x, cycle.y, cycle.last_x, cycle.last_y, cycle.last_vertex,
+                DIRECTION_CODES.index(cycle.direction), cycle.alive, cycle.speed, len(cycle.trail.vertices))
+            data += cycle.trail.vertices.tobytes()
+        data += self.grid.cells
+        return zlib.compress(data)
+
+    def load_state(self, state):
+        data = zlib.decompress(state)
+        self.tick, self.speed, seats = SIM_STATE.unpack_from(data)
+        offset = SIM_STATE.size
+        for cycle in self.cycles[:seats]:
+            (cycle.x, cycle.y, cycle.last_x, cycle.last_y, cycle.last_vertex,
+             direction, alive, cycle.speed, vertices) = CYCLE_STATE.unpack_from(data, offset)
+            offset += CYCLE_STATE.size
+            cycle.direction = DIRECTION_CODES[direction]
+            cycle.alive = bool(alive)
+            cycle.trail.vertices = array("i")
+            cycle.trail.vertices.frombytes(data[offset:offset + 4 * vertices])
+            offset += 4 * vertices
+            cycle.origin = None
+            cycle.path = set()
+            cycle.marked = set()
+            cycle.turns = []
+        self.grid.load(data[offset:])
+        self.game_over = False
+        self.winner = None
+
+    @property
+    def state(self):
+        return {
+            "tick": self.tick,
+            "cycles": [
+                {"x": cycle.x, "y": cycle.y, "direction": cycle.direction, "alive": cycle.alive}
+                for cycle in self.cycles
+            ],
+            "game_over": self.game_over,
+            "winner": self.winner
+        }
+
+
+class Snapshot:
+    def __init__(self, sim):
+        self.grid = sim.grid
+        self.position = sim.grid.journal_base + len(sim.grid.journal)
+        self.state = (sim.tick, sim.speed, sim.game_over, sim.winner, sim.rng.getstate())
+        self.cycles = [
+            (cycle.x, cycle.y, cycle.direction, cycle.alive, cycle.speed,
+             cycle.last_x, cycle.last_y, cycle.last_vertex,
+             len(cycle.trail.vertices), cycle.trail.vertices[-2:])
+            for cycle in sim.cycles]
+        self.recording = sim.recorder.position() if sim.recorder is not None else None
+
+
+def write_varint(out, value):
+    while value >= 0x80:
+        out.append(value & 0x7F | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def read_varint(data, offset):
+    value = shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+
+class ReplayRecorder:
+    # Replay format, little endian: a header with the seed and settings, one record per seat
+    # (difficulty code, color), then events, each a varint tick delta followed by
+    # seat * 4 + direction for a turn, REPLAY_SPEED and the new speed, or REPLAY_END.
+    # Every cycle's turns are recorded, AI included, so playback never depends on AI timing,
+    # and every turn is recorded in order, so two keypresses between ticks replay as two turns.
+    # After the events come keyframes (Simulation.save_state every REPLAY_KEYFRAME_INTERVAL
+    # ticks), an index of (tick, offset, length) per keyframe, and a footer with the index offset
+    def __init__(self, sim):
+        if len(sim.cycles) > REPLAY_SPEED // 4:
+            raise ValueError(f"replays hold at most {REPLAY_SPEED // 4} cycles")
+        self.data = bytearray(REPLAY_HEADER.pack(
+            REPLAY_MAGIC, REPLAY_VERSION, sim.width, sim.height, sim.speed, sim.seed or 0, len(sim.cycles)))
+        for difficulty, cycle in zip(sim.difficulties, sim.cycles):
+            self.data += REPLAY_SEAT.pack(DIFFICULTY_CODES.index(difficulty), *cycle.color)
+        self.speed = sim.speed
+        self.tick = 0
+        self.finished = False
+        self.keyframes = []
+
+    def event(self, tick, *payload):
+        write_varint(self.data, tick - self.tick)
+        self.data += bytes(payload)
+        self.tick = tick
+
+    def position(self):
+        return len(self.data), self.tick, self.speed, self.finished, len(self.keyframes)
+
+    def rewind(self, position):
+        # drops everything recorded after position, which came from an earlier position call
+        length, self.tick, self.speed, self.finished, keyframes = position
+        del self.data[length:]
+        del self.keyframes[keyframes:]
+
+    def record(self, sim):
+        # called before the cycles move, with the turns made since they last moved and the
+        # speed they will move with
+        if sim.speed != self.speed:
+            self.event(sim.tick, REPLAY_SPEED, sim.speed)
+            self.speed = sim.speed
+        for seat, cycle in enumerate(sim.cycles):
+            for direction in cycle.turns:
+                self.event(sim.tick, seat * 4 + DIRECTION_CODES.index(direction))
+
+    def stepped(self, sim):
+        # called after every tick
+        if sim.game_over:
+            self.finish(sim)
+        elif sim.tick % REPLAY_KEYFRAME_INTERVAL == 0:
+            self.keyframes.append((sim.tick, sim.save_state()))
+
+    def finish(self, sim):
+        if not self.finished:
+            self.event(sim.tick, REPLAY_END)
+            self.finished = True
+
+    def save(self, path):
+        data = bytearray(self.data)
+        index = bytearray()
+        for tick, state in self.keyframes:
+            index += REPLAY_INDEX_ENTRY.pack(tick, len(data), len(state))
+            data += state
+        index_offset = len(data)
+        data += index
+        data += REPLAY_FOOTER.pack(index_offset, REPLAY_INDEX_MAGIC)
+        with open(path, "wb") as f:
+            f.write(data)
+
+
+class Replay:
+    def __init__(self, data):
+        magic, version, self.width, self.height, self.speed, self.seed, seats = REPLAY_HEADER.unpack_from(data)
+        if magic != REPLAY_MAGIC or version not in (1, REPLAY_VERSION):
+            raise ValueError("not a replay file, or from an unsupported version")
+        self.data = data
+        offset = REPLAY_HEADER.size
+        self.difficulties = []
+        self.colors = []
+        for _ in range(seats):
+            code, *color = REPLAY_SEAT.unpack_from(data, offset)
+            offset += REPLAY_SEAT.size
+            self.difficulties.append(DIFFICULTY_CODES[code])
+            self.colors.append(tuple(color))
+
+        # tick -> [(seat, direction) or ("speed", speed)], in recording order
+        self.events = {}
+        self.ticks = None
+        tick = 0
+        while offset < len(data):
+            delta, offset = read_varint(data, offset)
+            tick += delta
+            code = data[offset]
+            offset += 1
+            if code == REPLAY_END:
+                self.ticks = tick
+                break
+            if code == REPLAY_SPEED:
+                event = ("speed", data[offset])
+                offset += 1
+            else:
+                event = (code // 4, DIRECTION_CODES[code % 4])
+            self.events.setdefault(tick, []).append(event)
+
+        # keyframe index as (tick, offset, length), sorted by tick
+        self.keyframes = []
+        if data[-len(REPLAY_INDEX_MAGIC):] == REPLAY_INDEX_MAGIC:
+            index_offset, _ = REPLAY_FOOTER.unpack_from(data, len(data) - REPLAY_FOOTER.size)
+            for entry in range(index_offset, len(data) - REPLAY_FOOTER.size, REPLAY_INDEX_ENTRY.size):
+                self.keyframes.append(REPLAY_INDEX_ENTRY.unpack_from(data, entry))
+        self.keyframe_ticks = [tick for tick, _, _ in self.keyframes]
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            return cls(f.read())
+
+    def simulation(self):
+        # every seat is driven by the recorded turns; difficulties only name the cycles
+        return Simulation(self.width, self.height, self.speed, self.difficulties, self.colors,
+                          external_ai=range(len(self.difficulties)), seed=self.seed)
+
+    def actions(self, sim):
+        # the recorded turns for sim's current tick; applies recorded speed changes directly, and
+        # so every turn but a seat's last when it turned more than once before this tick
+        actions = [None] * len(sim.cycles)
+        for seat, value in self.events.get(sim.tick, ()):
+            if seat == "speed":
+                sim.speed = value
+                for cycle in sim.cycles:
+                    cycle.speed = value
+            else:
+                if actions[seat] is not None:
+                    sim.cycles[seat].change_direction(actions[seat])
+                actions[seat] = value
+        return actions
+
+    def fast_forward(self, sim=None, until=None):
+        # runs the replay headless up to tick until, or to the end of the match
+        sim = sim or self.simulation()
+        end = self.ticks if until is None else until
+        while not sim.game_over and (end is None or sim.tick < end):
+            sim.step(self.actions(sim))
+        return sim
+
+    def seek(self, sim, tick):
+        # moves sim, built by simulation(), to tick: restores the nearest keyframe at or before
+        # tick, unless sim is already between it and tick, then simulates the rest
+        if self.ticks is not None:
+            tick = min(tick, self.ticks)
+        tick = max(tick, 0)
+        i = bisect_right(self.keyframe_ticks, tick)
+        start = self.keyframes[i - 1] if i else None
+        if sim.tick > tick or sim.tick < (start[0] if start else 0):
+            if start:
+                _, offset, length = start
+                sim.load_state(self.data[offset:offset + length])
+            else:
+                sim.speed = self.speed
+                sim.reset(self.seed)
+        return self.fast_forward(sim, tick)
+
+
+class SharedOccupancyGrid(OccupancyGrid):
+    # the AI worker's view of the game's grid. Only the cells are shared, so free-run tables
+    # kept here would never see the game's marks; free runs are counted from the cells instead
+    def __init__(self, width, height, buffer):
+        super().__init__(width, height)
+        self.cells = buffer[:len(self.cells)]
+
+    def reset_runs(self):
+        self.runs = None
+
+    def free_run(self, x, y, direction):
+        col, row = int(x) // self.cell, int(y) // self.cell
+        dx, dy = direction.value
+        cells, cols = self.cells, self.cols
+        run = -1
+        while (self.first_col <= col <= self.last_col and self.first_row <= row <= self.last_row
+               and not cells[row * cols + col]):
+            run += 1
+            col += dx
+            row += dy
+        return max(run, 0)
+
+
+def run_ai_worker(memory_name, width, height, budget_ms, requests, results):
+    from multiprocessing import shared_memory
+    memory = shared_memory.SharedMemory(name=memory_name)
+    grid = SharedOccupancyGrid(width, height, memory.buf)
+    while True:
+        request = requests.get()
+        while request is not None and not requests.empty():
+            request = requests.get()
+        if request is None:
+            break
+        tick, x, y, direction, speed, others = request
+        cycle = LightCycle(x, y, None, Direction[direction], {}, "AI", speed, is_ai=True, grid=grid)
+        opponents = []
+        for other_x, other_y, alive in others:
+            opponent = LightCycle(other_x, other_y, None, Direction.UP, {}, "", speed, grid=grid)
+            opponent.alive = alive
+            opponents.append(opponent)
+        choice = cycle.choose_territory_direction(opponents, budget_ms)
+        results.put((tick, choice.name if choice else None))
+    grid.cells.release()
+    memory.close()
+
+
+class AIWorker:
+    # runs the expert AI for one cycle in its own process; the occupancy grid is shared, so
+    # a request only carries the cycle heads
+    def __init__(self, width, height, budget_ms=AI_WORKER_BUDGET_MS):
+        # imported here, as most games never start a worker
+        import multiprocessing
+        from multiprocessing import shared_memory
+        self.size = (width // COLLISION_CELL + 1) * (height // COLLISION_CELL + 1)
+        self.memory = shared_memory.SharedMemory(create=True, size=self.size)
+        self.requests = multiprocessing.Queue()
+        self.results = multiprocessing.Queue()
+        self.process = multiprocessing.Process(
+            target=run_ai_worker,
+            args=(self.memory.name, width, height, budget_ms, self.requests, self.results),
+            daemon=True)
+        self.process.start()
+        self.grid = None
+        self.decision = None
+        self.hits = 0
+        self.misses = 0
+
+    def attach(self, grid):
+        self.release()
+        view = self.memory.buf[:self.size]
+        view[:] = grid.cells
+        grid.cells = view
+        self.grid = grid
+        self.decision = None
+
+    def release(self):
+        if self.grid is not None:
+            view = self.grid.cells
+            self.grid.cells = bytearray(view)
+            view.release()
+            self.grid = None
+
+    def request(self, sim, seat):
+        cycle = sim.cycles[seat]
+        others = [(other.x, other.y, other.alive) for other in sim.cycles if other is not cycle]
+        self.requests.put((sim.tick, cycle.x, cycle.y, cycle.direction.name, cycle.speed, others))
+
+    def poll(self, sim, seat):
+        # the worker's move for this tick, or the cheap safe-direction check if it missed the deadline
+        while True:
+            try:
+                tick, name = self.results.get_nowait()
+            except queue.Empty:
+                break
+            if tick == sim.tick and name is not None:
+                self.decision = (tick, Direction[name])
+        if self.decision is not None and self.decision[0] == sim.tick:
+            self.hits += 1
+            return self.decision[1]
+        self.misses += 1
+        return sim.cycles[seat].choose_safe_direction()
+
+    def close(self):
+        self.requests.put(None)
+        self.process.join(timeout=1)
+        self.release()
+        self.memory.close()
+        self.memory.unlink()
+
+
+class TrailLayer:
+    def __init__(self, size):
+        self.surface = pygame.Surface(size)
+        self.surface.set_colorkey((0, 0, 0))
+        self.progress = {}
+
+    def clear(self):
+        self.surface.fill((0, 0, 0))
+        self.progress = {}
+
+    def update(self, cycles):
+        # only the newest segments are drawn; a color change, or a dead cycle alive again after
+        # a restore, wipes the layer. progress keeps the vertex and position each trail was last
+        # drawn up to, and whether it is finished; live trails stop before the latest move, which
+        # is drawn interpolated on top. A dead cycle's trail stays in the arena, so it is drawn
+        # to its end, fatal move included, and then left alone. Returns the rects that changed
+        changed = []
+        for cycle in cycles:
+            drawn = self.progress.get(cycle)
+            if drawn is not None and (drawn[2] != cycle.color or drawn[3] and cycle.alive):
+                self.surface.fill((0, 0, 0))
+                self.progress = {}
+                changed.append(self.surface.get_rect())
+                break
+        for cycle in cycles:
+            start, origin, _, finished = self.progress.get(cycle, (0, None, None, False))
+            if finished:
+                continue
+            rect = cycle.draw_trail(self.surface, start, origin, settled=cycle.alive)
+            if rect is not None:
+                changed.append(rect)
+            self.progress[cycle] = (cycle.last_vertex, (cycle.last_x, cycle.last_y), cycle.color, not cycle.alive)
+        return changed
+
+
+class TextCache:
+    # rendered text surfaces keyed by (text, color, antialias), least recently used evicted first
+    def __init__(self, font, size=128):
+        self.font = font
+        self.size = size
+        self.surfaces = OrderedDict()
+
+    def render(self, text, color=(255, 255, 255), antialias=True):
+        key = (text, color, antialias)
+        surface = self.surfaces.get(key)
+        if surface is None:
+            surface = self.font.render(text, antialias, color)
+            self.surfaces[key] = surface
+            if len(self.surfaces) > self.size:
+                self.surfaces.popitem(last=False)
+        else:
+            self.surfaces.move_to_end(key)
+        return surface
+
+
+class SettingsWriter:
+    # persists settings off the render thread. save only records the latest settings; a
+    # background thread writes them once they have been left alone for delay seconds, and
+    # settings equal to those last written are never written again. Each write goes to a
+    # temporary file that then replaces the old one, so a crash leaves the old or the new file
+    def __init__(self, path, written=None, delay=SETTINGS_DELAY):
+        self.path = path
+        self.written = written
+        self.delay = delay
+        self.pending = None
+        self.due = 0.0
+        self.closed = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def save(self, settings):
+        with self.condition:
+            if settings == self.written:
+                self.pending = None
+            elif settings != self.pending:
+                self.pending = settings
+                self.due = monotonic() + self.delay
+                self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.pending is None and not self.closed:
+                    self.condition.wait()
+                if self.pending is None:
+                    return
+                remaining = self.due - monotonic()
+                if remaining > 0 and not self.closed:
+                    self.condition.wait(remaining)
+                    continue
+                settings = self.pending
+                self.pending = None
+            if self.write(settings):
+                with self.condition:
+                    self.written = settings
+
+    def write(self, settings):
+        fd, temp_path = tempfile.mkstemp(prefix=".settings-", suffix=".tmp",
+                                         dir=os.path.dirname(os.path.abspath(self.path)))
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(settings, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self.path)
+            return True
+        except OSError as error:
+            print(f"Settings: could not write {self.path} ({error})", file=sys.stderr)
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            return False
+
+    def close(self):
+        # writes anything still pending right away and stops the thread
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
+
+
+class SoundBank:
+    # opens the audio device and loads the sounds on a background thread the first time they
+    # are wanted, so neither holds up a frame. Until they are loaded, and without an audio
+    # device or the sound files, play is silent
+    def __init__(self, files):
+        self.files = files
+        self.sounds = {}
+        self.thread = None
+        self.load_time = None
+
+    def load(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def run(self):
+        start = perf_counter()
+        try:
+            pygame.mixer.init()
+        except pygame.error as error:
+            print(f"Sound: no audio device ({error})", file=sys.stderr)
+            return
+        sounds = {}
+        for name, path in self.files.items():
+            try:
+                sounds[name] = pygame.mixer.Sound(path)
+            except (pygame.error, OSError):
+                pass
+        self.sounds = sounds
+        self.load_time = perf_counter() - start
+
+    def play(self, name):
+        self.load()
+        sound = self.sounds.get(name)
+        if sound:
+            sound.play()
+
+    def close(self):
+        if self.thread:
+            self.thread.join()
+
+
+class StartupTimer:
+    # cold start split into phases, from TRON starting to import (pygame included) to the first
+    # frame on screen; each mark ends the phase since the previous one
+    def __init__(self, budget_ms=None):
+        self.budget_ms = budget_ms
+        self.phases = [("import", IMPORT_END - IMPORT_START)]
+        self.last = IMPORT_END
+
+    def mark(self, name):
+        now = perf_counter()
+        self.phases.append((name, now - self.last))
+        self.last = now
+
+    def total_ms(self):
+        return (self.last - IMPORT_START) * 1000
+
+    def over_budget(self):
+        return self.budget_ms is not None and self.total_ms() > self.budget_ms
+
+    def report(self):
+        phases = ", ".join(f"{name} {seconds * 1000:.1f} ms" for name, seconds in self.phases)
+        print(f"Startup: {phases}", file=sys.stderr)
+        line = f"Startup: first frame after {self.total_ms():.1f} ms"
+        if self.budget_ms is not None:
+            line += f", {'over' if self.over_budget() else 'within'} the {self.budget_ms:g} ms budget"
+        print(line, file=sys.stderr)
+
+
+class FrameProfiler:
+    # times the phases of every frame into a ring buffer of the latest capacity frames: input
+    # handling, update (the simulation ticks less their AI), ai, draw, and idle, the wait for
+    # the frame cap. Phases are marked as they end; the simulation records its AI time itself
+    PHASES = ("input", "update", "ai", "draw", "idle")
+
+    def __init__(self, capacity=PROFILE_FRAMES):
+        self.capacity = capacity
+        self.frames = 0
+        self.starts = array("d", [0.0]) * capacity
+        self.durations = {phase: array("d", [0.0]) * capacity for phase in self.PHASES}
+        self.offsets = {phase: array("d", [0.0]) * capacity for phase in self.PHASES}
+        self.frame_start = self.last = perf_counter()
+        self.current = {}
+
+    def record(self, phase, start, seconds):
+        # a phase may run several times a frame, like update during catch-up; its offset is
+        # where it first started
+        duration, offset = self.current.get(phase, (0.0, start - self.frame_start))
+        self.current[phase] = (duration + seconds, offset)
+
+    def mark(self, phase):
+        # ends phase, which ran since the previous mark
+        now = perf_counter()
+        self.record(phase, self.last, now - self.last)
+        self.last = now
+
+    def next_frame(self):
+        i = self.frames % self.capacity
+        self.starts[i] = self.frame_start
+        for phase in self.PHASES:
+            self.durations[phase][i], self.offsets[phase][i] = self.current.get(phase, (0.0, 0.0))
+        # update was marked around the whole tick, AI included
+        self.durations["update"][i] = max(self.durations["update"][i] - self.durations["ai"][i], 0.0)
+        self.frames += 1
+        self.frame_start = self.last
+        self.current = {}
+
+    def order(self):
+        # ring indexes from the oldest frame to the newest
+        count = min(self.frames, self.capacity)
+        first = self.frames - count
+        return [i % self.capacity for i in range(first, self.frames)]
+
+    def samples(self, phase=None):
+        # seconds per frame for phase, or for the whole frame
+        if phase is not None:
+            durations = self.durations[phase]
+            return [durations[i] for i in self.order()]
+        return [sum(self.durations[phase][i] for phase in self.PHASES) for i in self.order()]
+
+    def percentiles(self, phase=None):
+        # p50, p95 and p99 in ms
+        samples = sorted(self.samples(phase))
+        if not samples:
+            return 0.0, 0.0, 0.0
+        return tuple(samples[min(int(len(samples) * fraction), len(samples) - 1)] * 1000
+                     for fraction in (0.5, 0.95, 0.99))
+
+    def histogram(self):
+        # frame counts in 1 ms bins; the last bin holds every frame of PROFILE_HISTOGRAM_MS or more
+        bins = [0] * PROFILE_HISTOGRAM_MS
+        for seconds in self.samples():
+            bins[min(int(seconds * 1000), PROFILE_HISTOGRAM_MS - 1)] += 1
+        return bins
+
+    def chrome_trace(self):
+        # the buffer as Chrome trace events (chrome://tracing, Perfetto): a complete event per
+        # frame with its phases nested inside, ai within update
+        events = []
+        for i in self.order():
+            start = self.starts[i]
+            total = sum(self.durations[phase][i] for phase in self.PHASES)
+            events.append({"name": "frame", "ph": "X", "pid": 1, "tid": 1,
+                           "ts": start * 1e6, "dur": total * 1e6})
+            for phase in self.PHASES:
+                duration = self.durations[phase][i]
+                if phase == "update":
+                    duration += self.durations["ai"][i]
+                if duration > 0:
+                    events.append({"name": phase, "ph": "X", "pid": 1, "tid": 1,
+                                   "ts": (start + self.offsets[phase][i]) * 1e6, "dur": duration * 1e6})
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def save_trace(self, path):
+        with open(path, "w") as f:
+            json.dump(self.chrome_trace(), f)
+
+
+class MemoryDiagnostics:
+    # for long sessions: tracemalloc measures what the hot functions allocate, gc callbacks time
+    # every collection and flag those longer than a frame, and after each match is torn down
+    # the traced memory is compared with the first teardown's, once caches have warmed up.
+    # Functions are instrumented by wrapping them on their class while installed; a call's
+    # allocated bytes are its peak above the memory traced when it started, its retained bytes
+    # what is still traced when it returns. tracemalloc is imported by the methods that use it,
+    # so games without diagnostics never load it
+    def __init__(self, frame_budget):
+        self.frame_budget = frame_budget
+        self.stats = {}
+        self.stack = []
+        self.originals = []
+        self.gc_start = None
+        self.collecting = False
+        self.gc_pauses = [0, 0.0, 0.0]
+        self.slow_collections = 0
+        self.baseline = None
+        self.baseline_snapshot = None
+        self.matches = 0
+
+    def install(self):
+        import tracemalloc
+        tracemalloc.start()
+        gc.callbacks.append(self.on_collection)
+        for cls, name in ((LightCycle, "move"), (LightCycle, "ai_move"), (LightCycle, "draw"),
+                          (LightCycle, "draw_trail"), (Game, "draw")):
+            original = cls.__dict__[name]
+            setattr(cls, name, self.instrument(f"{cls.__name__}.{name}", original))
+            self.originals.append((cls, name, original))
+
+    def uninstall(self):
+        import tracemalloc
+        for cls, name, original in self.originals:
+            setattr(cls, name, original)
+        self.originals = []
+        gc.callbacks.remove(self.on_collection)
+        tracemalloc.stop()
+
+    def instrument(self, label, function):
+        import tracemalloc
+        stats = self.stats.setdefault(label, [0, 0, 0])
+        stack = self.stack
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            # calls nest, like draw_trail inside Game.draw, and resetting the traced peak for the
+            # inner one would lose the outer one's, so each keeps its own peak on the stack
+            current, peak = tracemalloc.get_traced_memory()
+            if stack:
+                stack[-1][1] = max(stack[-1][1], peak)
+            tracemalloc.reset_peak()
+            frame = [current, current]
+            stack.append(frame)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                stack.pop()
+                end, peak = tracemalloc.get_traced_memory()
+                peak = max(peak, frame[1])
+                stats[0] += 1
+                stats[1] += peak - frame[0]
+                stats[2] += end - frame[0]
+                if stack:
+                    stack[-1][1] = max(stack[-1][1], peak)
+        return wrapper
+
+    def on_collection(self, phase, info):
+        if self.collecting:
+            return
+        if phase == "start":
+            self.gc_start = perf_counter()
+            return
+        if self.gc_start is None:
+            return
+        pause = perf_counter() - self.gc_start
+        self.gc_start = None
+        self.gc_pauses[0] += 1
+        self.gc_pauses[1] += pause
+        self.gc_pauses[2] = max(self.gc_pauses[2], pause)
+        if pause > self.frame_budget:
+            self.slow_collections += 1
+            print(f"Memory: generation {info['generation']} collection took {pause * 1000:.1f} ms, over the "
+                  f"{self.frame_budget * 1000:.1f} ms frame budget ({info['collected']} objects freed)",
+                  file=sys.stderr)
+
+    def report(self, ticks):
+        # allocations of the match that just ended, per tick and per call; the counters restart
+        self.matches += 1
+        print(f"Memory: match {self.matches}, {ticks} ticks", file=sys.stderr)
+        for label, (calls, allocated, retained) in self.stats.items():
+            if calls:
+                print(f"  {label:22} {calls:7} calls  {allocated / max(ticks, 1) / 1024:8.1f} KiB allocated "
+                      f"and {retained / max(ticks, 1):8.1f} B retained per tick, "
+                      f"{allocated / calls:8.0f} B per call", file=sys.stderr)
+            self.stats[label][:] = [0, 0, 0]
+        count, total, longest = self.gc_pauses
+        print(f"  {count} collections, {total * 1000:.1f} ms in total, longest {longest * 1000:.1f} ms, "
+              f"{self.slow_collections} over the frame budget", file=sys.stderr)
+        self.gc_pauses = [0, 0.0, 0.0]
+        self.slow_collections = 0
+
+    def check_baseline(self):
+        # after a match is torn down: the first teardown sets the baseline, later ones are
+        # compared with it and list the lines holding most of any growth
+        import tracemalloc
+        self.collecting = True
+        gc.collect()
+        self.collecting = False
+        current = tracemalloc.get_traced_memory()[0]
+        if self.baseline is None:
+            self.baseline = current
+            self.baseline_snapshot = tracemalloc.take_snapshot()
+            print(f"Memory: baseline {current / 1024:.0f} KiB traced after the first match", file=sys.stderr)
+            return
+        growth = current - self.baseline
+        print(f"Memory: {current / 1024:.0f} KiB traced after teardown, {growth / 1024:+.0f} KiB from baseline",
+              file=sys.stderr)
+        if growth > MEMORY_GROWTH_LIMIT:
+            print("  teardown did not return to baseline; largest growth:", file=sys.stderr)
+            for stat in tracemalloc.take_snapshot().compare_to(self.baseline_snapshot, "lineno")[:5]:
+                print(f"    {stat}", file=sys.stderr)
+
+
 class Game:
-    def __init__(self):
-        pygame.init()
-        pygame.mixer.init()
+    def __init__(self, ai_worker=False, tick_rate=TICK_RATE, frame_rate=60, cycles=2, record=None, replay=None,
+                 host=None, join=None, rollback=False, spectate_port=None, size=None, profile=False,
+                 profile_trace=None, memory_diagnostics=False, startup_report=False, startup_budget=None,
+                 startup_exit=False):
+        # record is a path the last match's replay is written to; replay is a Replay to watch;
+        # host is a port to wait for a netplay peer on and join a (host, port) to connect to,
+        # with rollback predicting the peer's inputs instead of waiting for them; spectate_port
+        # streams every match to spectators; size plays in a window instead of fullscreen.
+        # profile times every frame from the start (F3 shows the timings, F4 saves them as a
+        # Chrome trace), and profile_trace is a path the trace is saved to on quit;
+        # memory_diagnostics reports allocations and collections, see MemoryDiagnostics.
+        # startup_report prints how long each startup phase took once the first frame is on
+        # screen, checked against startup_budget milliseconds; startup_exit quits right after,
+        # with exit status 1 when over budget.
+        # Only the display and fonts are initialized up front; the mixer and sounds are left to
+        # self.sounds, loaded in the background once a match starts
+        self.startup = StartupTimer(startup_budget)
+        self.startup_report = startup_report or startup_budget is not None or startup_exit
+        self.startup_exit = startup_exit
+        self.startup.mark("main")
+        pygame.display.init()
+        pygame.font.init()
         self.screen_info = pygame.display.Info()
-        self.screen_width = self.screen_info.current_w
-        self.screen_height = self.screen_info.current_h
-        self.screen = pygame.display.set_mode(
-            (self.screen_width, self.screen_height), pygame.FULLSCREEN)
+        if size is None:
+            self.screen_width = self.screen_info.current_w
+            self.screen_height = self.screen_info.current_h
+            self.screen = pygame.display.set_mode(
+                (self.screen_width, self.screen_height), pygame.FULLSCREEN)
+        else:
+            self.screen_width, self.screen_height = size
+            self.screen = pygame.display.set_mode(size)
         pygame.display.set_caption("Tron Light Cycle")
+        self.startup.mark("display")
         self.clock = pygame.time.Clock()
+        self.tick_rate = tick_rate
+        self.cycle_count = cycles
+        self.record_path = record
+        self.replay = replay
+        self.frame_rate = frame_rate
+        self.alpha = 1.0
         self.font = pygame.font.Font(None, 72)
+        self.text = TextCache(self.font)
+        self.hud_text = None
+        self.startup.mark("fonts")
+        self.profiler = FrameProfiler() if profile or profile_trace else None
+        self.profile_trace = profile_trace
+        self.show_profile = False
+        self.profile_hud = None
+        self.profile_hud_time = 0.0
+        self.memory = None
+        if memory_diagnostics:
+            self.memory = MemoryDiagnostics(1 / (frame_rate or TICK_RATE))
+            self.memory.install()
+        self.screens = {}
+        self.presented = None
+        self.overlays = []
+        self.overlay_rects = []
         self.state = "home"
         self.paused = False
         self.countdown = None
@@ -172,20 +1477,31 @@ class Game:
             pygame.K_RIGHT: Direction.RIGHT
         }
 
-        try:
-            self.collision_sound = pygame.mixer.Sound("collision.wav")
-        except:
-            self.collision_sound = None
-        try:
-            self.victory_sound = pygame.mixer.Sound("victory.wav")
-        except:
-            self.victory_sound = None
+        self.sounds = SoundBank(SOUND_FILES)
 
-        self.load_settings()
-        self.cycle1 = None
-        self.cycle2 = None
-        self.game_over = False
-        self.winner = None
+        self.settings_writer = SettingsWriter(SETTINGS_PATH, self.load_settings())
+        self.startup.mark("settings")
+        self.spectators = None
+        if spectate_port is not None:
+            import spectate
+            self.spectators = spectate.SpectatorServer()
+            self.spectators.start_thread("", spectate_port)
+        self.net = None
+        self.net_direction = None
+        self.net_error = None
+        if host is not None or join is not None:
+            import netplay
+            session = netplay.RollbackSession if rollback else netplay.LockstepSession
+        if host is not None:
+            print(f"Waiting for a peer on port {host}...", file=sys.stderr)
+            self.net = session.host(
+                host, random.randrange(1 << 32), self.screen_width, self.screen_height, self.speed,
+                netplay.ROLLBACK_DELAY if rollback else netplay.INPUT_DELAY)
+        elif join is not None:
+            self.net = session.join(join)
+        self.sim = None
+        self.trail_layer = None
+        self.ai_worker = AIWorker(self.screen_width, self.screen_height) if ai_worker else None
         self.in_settings = False
         self.single_player = False
 
@@ -197,7 +1513,7 @@ class Game:
             (0, 0, 255)
         ]
         self.speed_options = [5, 10, 15, 20]
-        self.difficulty_options = ["easy", "medium", "hard"]
+        self.difficulty_options = ["easy", "medium", "hard", "expert"]
 
         self.settings_button_rect = pygame.Rect(self.screen_width - 150, 20, 100, 50)
         self.exit_settings_rect = pygame.Rect(
@@ -212,81 +1528,175 @@ class Game:
             self.screen_width // 2 - 150, self.screen_height // 2, 300, 80)
         self.pause_home_rect = pygame.Rect(
             self.screen_width // 2 - 150, self.screen_height // 2 + 100, 300, 80)
+        self.scrub_rect = pygame.Rect(40, self.screen_height - 50, self.screen_width - 80, 20)
+
+        # a netplay session plays a single match, started right away
+        if self.net:
+            self.init_game(False)
+
+    @property
+    def cycle1(self):
+        return self.sim.cycles[0] if self.sim else None
+
+    @property
+    def cycle2(self):
+        return self.sim.cycles[1] if self.sim else None
+
+    @property
+    def game_over(self):
+        # a netplay match that ended on predicted inputs may still be rolled back
+        return (self.sim is not None and self.sim.game_over and
+                (self.net is None or self.net_error is not None or self.net.settled(self.sim)))
+
+    @property
+    def winner(self):
+        return self.sim.winner if self.sim else None
 
     def load_settings(self):
+        # returns the settings as read, or None when the defaults are used
+        self.p1_color = (0, 255, 255)
+        self.p2_color = (255, 255, 0)
+        self.speed = 10
+        self.difficulty = "medium"
         try:
-            with open("settings.json", "r") as f:
+            with open(SETTINGS_PATH, "r") as f:
                 settings = json.load(f)
-                self.p1_color = tuple(settings["p1_color"])
-                self.p2_color = tuple(settings["p2_color"])
-                self.speed = settings["speed"]
-                self.difficulty = settings.get("difficulty", "medium")
-        except:
-            self.p1_color = (0, 255, 255)
-            self.p2_color = (255, 255, 0)
-            self.speed = 10
-            self.difficulty = "medium"
+            p1_color = tuple(settings["p1_color"])
+            p2_color = tuple(settings["p2_color"])
+            speed = settings["speed"]
+            difficulty = settings.get("difficulty", "medium")
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, TypeError) as error:
+            print(f"Settings: could not read {SETTINGS_PATH} ({error!r}), using the defaults", file=sys.stderr)
+            return None
+        self.p1_color, self.p2_color, self.speed, self.difficulty = p1_color, p2_color, speed, difficulty
+        return settings
 
     def save_settings(self):
+        # cheap enough to call from any click: the writer thread coalesces and skips unchanged settings
         settings = {
             "p1_color": list(self.cycle1.color) if self.cycle1 else list(self.p1_color),
             "p2_color": list(self.cycle2.color) if self.cycle2 else list(self.p2_color),
             "speed": self.speed,
             "difficulty": self.difficulty
         }
-        with open("settings.json", "w") as f:
-            json.dump(settings, f)
+        self.settings_writer.save(settings)
 
     def init_game(self, single_player):
         self.single_player = single_player
-        self.cycle1 = LightCycle(
-            self.screen_width // 4, self.screen_height // 2,
-            self.p1_color, Direction.RIGHT, self.player1_controls,
-            "Player 1", self.speed)
-        self.cycle2 = LightCycle(
-            3 * self.screen_width // 4, self.screen_height // 2,
-            self.p2_color, Direction.LEFT,
-            self.player2_controls if not single_player else {},
-            "AI" if single_player else "Player 2", self.speed, is_ai=single_player)
-        self.game_over = False
-        self.winner = None
+        self.sounds.load()
+        if self.replay:
+            self.sim = self.replay.simulation()
+        elif self.net:
+            # both peers build the host's arena; each steers its own seat through net_direction
+            self.sim = Simulation(self.net.width, self.net.height, self.net.speed, (None, None),
+                                  (self.p1_color, self.p2_color), seed=self.net.seed)
+            self.net.record_checksum(0, self.sim.checksum())
+            self.net_direction = None
+        else:
+            self.sim = Simulation(
+                self.screen_width, self.screen_height, self.speed,
+                (None, self.difficulty if single_player else None) + (self.difficulty,) * (self.cycle_count - 2),
+                (self.p1_color, self.p2_color), (self.player1_controls, self.player2_controls),
+                seed=random.randrange(1 << 32))
+        if self.record_path and not self.replay:
+            # seeking a replay rewinds the match, which a recording cannot follow
+            self.sim.recorder = ReplayRecorder(self.sim)
+        self.sim.profiler = self.profiler
+        self.trail_layer = TrailLayer(self.screen.get_size())
+        self.assign_ai_worker()
         self.in_settings = False
         self.paused = False
         self.countdown = time()
         self.state = "game"
+        self.presented = None
+        if self.spectators:
+            self.spectators.publish(self.sim)
+
+    def assign_ai_worker(self):
+        # the worker only plays the expert opponent of a local single player match, and only
+        # then is the grid moved into shared memory
+        use_worker = (self.ai_worker is not None and self.single_player and self.difficulty == "expert"
+                      and not self.replay and not self.net)
+        if use_worker and self.ai_worker.grid is not self.sim.grid:
+            self.ai_worker.attach(self.sim.grid)
+            self.ai_worker.request(self.sim, 1)
+        elif not use_worker and self.ai_worker is not None:
+            self.ai_worker.release()
+        self.sim.external_ai = {1} if use_worker else set()
 
     def reset_game(self):
-        self.cycle1 = None
-        self.cycle2 = None
-        self.game_over = False
-        self.winner = None
+        if self.net:
+            self.quit()
+        if self.memory and self.sim:
+            self.memory.report(self.sim.tick)
+        if self.ai_worker:
+            self.ai_worker.release()
+        self.sim = None
+        self.trail_layer = None
+        self.overlays = []
+        self.overlay_rects = []
         self.in_settings = False
         self.paused = False
         self.countdown = None
         self.state = "home"
+        self.presented = None
+        if self.memory:
+            self.memory.check_baseline()
+
+    def quit(self, status=0):
+        self.save_settings()
+        self.settings_writer.close()
+        self.sounds.close()
+        if self.profiler and self.profile_trace:
+            self.profiler.save_trace(self.profile_trace)
+        if self.memory and self.sim:
+            self.memory.report(self.sim.tick)
+        if self.ai_worker:
+            self.ai_worker.close()
+        if self.net:
+            self.net.close()
+        pygame.quit()
+        sys.exit(status)
 
     def handle_keyboard_input(self):
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
-                self.save_settings()
-                pygame.quit()
-                sys.exit()
+                self.quit()
             if event.type == pygame.KEYDOWN:
+                if event.key == pygame.K_F3:
+                    self.toggle_profile()
+                elif event.key == pygame.K_F4 and self.profiler:
+                    path = strftime("frame-trace-%Y%m%d-%H%M%S.json")
+                    self.profiler.save_trace(path)
+                    print(f"Frame trace saved to {path}", file=sys.stderr)
                 if self.state == "game" and not self.in_settings and not self.paused and self.countdown is None:
-                    if event.key in self.cycle1.key_controls and self.cycle1.alive:
-                        self.cycle1.change_direction(self.cycle1.key_controls[event.key])
-                    if (not self.single_player and
-                            event.key in self.cycle2.key_controls and self.cycle2.alive):
-                        self.cycle2.change_direction(self.cycle2.key_controls[event.key])
+                    if self.net:
+                        controls = {**self.player1_controls, **self.player2_controls}
+                        if event.key in controls:
+                            self.net_direction = controls[event.key]
+                    for cycle in self.sim.cycles:
+                        if event.key in cycle.key_controls and cycle.alive:
+                            cycle.change_direction(cycle.key_controls[event.key])
                     if event.key == pygame.K_SPACE and self.game_over:
                         self.save_settings()
                         self.reset_game()
-                if event.key == pygame.K_ESCAPE:
+                if event.key == pygame.K_ESCAPE and not self.net:
                     if self.state == "game" and not self.game_over and not self.in_settings:
                         self.paused = not self.paused
                     elif self.paused:
                         self.paused = False
 
+    def toggle_profile(self):
+        # the profiler starts with the HUD when the game was not launched with one
+        if self.profiler is None:
+            self.profiler = FrameProfiler()
+            if self.sim:
+                self.sim.profiler = self.profiler
+        self.show_profile = not self.show_profile
+        self.profile_hud = None
+
     def handle_mouse_input(self):
         mouse_buttons = pygame.mouse.get_pressed()
         if mouse_buttons[0]:
@@ -299,7 +1709,11 @@ class Game:
                     self.init_game(False)
 
             elif self.state == "game":
-                if self.game_over:
+                if (self.replay and self.replay.ticks and not self.paused and not self.in_settings and
+                        self.scrub_rect.collidepoint(mouse_pos)):
+                    self.seek_replay(mouse_pos[0])
+
+                elif self.game_over:
                     restart_rect = pygame.Rect(
                         self.screen_width // 2 - 150, self.screen_height // 2 + 50, 300, 100)
                     if restart_rect.collidepoint(mouse_pos):
@@ -334,8 +1748,9 @@ class Game:
                             self.screen_height // 2 - 50 + i * 60, 100, 50)
                         if speed_rect.collidepoint(mouse_pos):
                             self.speed = speed
-                            self.cycle1.speed = speed
-                            self.cycle2.speed = speed
+                            self.sim.speed = speed
+                            for cycle in self.sim.cycles:
+                                cycle.speed = speed
 
                     for i, difficulty in enumerate(self.difficulty_options):
                         diff_rect = pygame.Rect(
@@ -343,184 +1758,419 @@ class Game:
                             self.screen_height // 2 - 50 + i * 60, 100, 50)
                         if diff_rect.collidepoint(mouse_pos) and self.single_player:
                             self.difficulty = difficulty
+                            self.sim.difficulties[1:] = [difficulty] * (len(self.sim.difficulties) - 1)
+                            self.assign_ai_worker()
 
                     if self.exit_settings_rect.collidepoint(mouse_pos):
                         self.save_settings()
                         self.in_settings = False
 
-                else:
+                elif not self.net:
                     if self.settings_button_rect.collidepoint(mouse_pos):
                         self.in_settings = True
 
+    def seek_replay(self, x):
+        # jumps the replay to the tick under x on the scrub bar; the trails are redrawn from scratch
+        fraction = min(max((x - self.scrub_rect.x) / self.scrub_rect.width, 0), 1)
+        tick = round(fraction * self.replay.ticks)
+        self.countdown = None
+        if tick != self.sim.tick:
+            self.replay.seek(self.sim, tick)
+            self.trail_layer = TrailLayer(self.screen.get_size())
+            self.presented = None
+            if self.spectators:
+                self.spectators.publish(self.sim)
+
     def update(self):
-        if self.state != "game" or self.game_over or self.in_settings or self.paused or self.countdown is not None:
+        if self.net and self.state == "game":
+            if not self.update_net():
+                return
+        elif not self.running():
             return
+        elif self.replay:
+            self.sim.step(self.replay.actions(self.sim))
+        else:
+            use_worker = self.ai_worker is not None and self.ai_worker.grid is self.sim.grid
+            actions = [None, self.ai_worker.poll(self.sim, 1) if use_worker else None]
+            self.sim.step(actions)
+            if use_worker and not self.sim.game_over:
+                self.ai_worker.request(self.sim, 1)
+        if self.spectators:
+            self.spectators.publish(self.sim)
+        if self.game_over:
+            if self.sim.recorder is not None:
+                self.sim.recorder.save(self.record_path)
+            self.sounds.play("collision")
+            self.sounds.play("victory")
+
+    def update_net(self):
+        # the session is serviced every tick, during the countdown and after the match so the
+        # peer gets our last inputs; the simulation advances as the session allows, waiting for
+        # the peer's inputs in lockstep or predicting them with rollback. Returns True when the
+        # simulation changed
+        code = 0
+        if self.running() and self.net_direction is not None:
+            code = 1 + DIRECTION_CODES.index(self.net_direction)
+        if self.net.update(self.sim.tick, code):
+            self.net_direction = None
+        if self.game_over:
+            return False
+        if self.net.timed_out or self.net.desync_tick is not None:
+            if self.net.timed_out:
+                self.net_error = "lost contact with the peer"
+            else:
+                self.net_error = f"desync detected at tick {self.net.desync_tick}"
+            print(f"Netplay: {self.net_error}", file=sys.stderr)
+            self.sim.game_over = True
+            self.sim.winner = "Nobody"
+            return False
+        if not self.running():
+            return False
+        advanced = self.net.advance(self.sim)
+        if self.net.rollback_depth:
+            # trails may have been cut back, so they are redrawn from scratch
+            self.trail_layer.clear()
+            self.presented = None
+        return advanced
+
+    def static_screen(self, name):
+        # home, pause and settings never change while shown, so each is composed once per
+        # resolution and player mode and then blitted whole; the bare arena is the play background
+        key = (name, self.screen.get_size(), self.single_player)
+        surface = self.screens.get(key)
+        if surface is None:
+            surface = pygame.Surface(self.screen.get_size())
+            if name != "home":
+                pygame.draw.rect(
+                    surface, (255, 0, 0),
+                    (0, 0, self.screen_width, self.screen_height), 10)
+            if name != "arena":
+                getattr(self, "draw_" + name)(surface)
+            self.screens[key] = surface
+        return surface
+
+    def draw_home(self, surface):
+        title_text = self.text.render("Tron Light Cycle")
+        single_text = self.text.render("Single Player")
+        multi_text = self.text.render("Multiplayer")
+
+        surface.blit(
+            title_text,
+            (self.screen_width // 2 - title_text.get_width() // 2, self.screen_height // 2 - 250))
+        surface.blit(
+            single_text,
+            (self.screen_width // 2 - single_text.get_width() // 2, self.screen_height // 2 - 90))
+        surface.blit(
+            multi_text,
+            (self.screen_width // 2 - multi_text.get_width() // 2, self.screen_height // 2 + 60))
+
+    def draw_pause(self, surface):
+        pause_text = self.text.render("Paused")
+        resume_text = self.text.render("Resume")
+        restart_text = self.text.render("Restart")
+        home_text = self.text.render("Back to Home")
 
-        self.cycle1.move()
-        self.cycle2.move()
+        surface.blit(
+            pause_text,
+            (self.screen_width // 2 - pause_text.get_width() // 2, self.screen_height // 2 - 200))
+        surface.blit(
+            resume_text,
+            (self.screen_width // 2 - resume_text.get_width() // 2, self.screen_height // 2 - 90))
+        surface.blit(
+            restart_text,
+            (self.screen_width // 2 - restart_text.get_width() // 2, self.screen_height // 2 + 10))
+        surface.blit(
+            home_text,
+            (self.screen_width // 2 - home_text.get_width() // 2, self.screen_height // 2 + 110))
 
+    def draw_settings(self, surface):
+        p1_label = self.text.render("Player 1 Colors")
+        p2_label = self.text.render(f"{'AI' if self.single_player else 'Player 2'} Colors")
+        speed_label = self.text.render("Speed")
+
+        surface.blit(
+            p1_label,
+            (self.screen_width // 4 - p1_label.get_width() // 2, self.screen_height // 2 - 150))
+        surface.blit(
+            p2_label,
+            (3 * self.screen_width // 4 - p2_label.get_width() // 2, self.screen_height // 2 - 150))
+        surface.blit(
+            speed_label,
+            (self.screen_width // 2 - 100 - speed_label.get_width() // 2, self.screen_height // 2 - 150))
         if self.single_player:
-            self.cycle2.ai_move(
-                self.cycle1.trail, self.screen_width, self.screen_height,
-                self.difficulty, self.cycle1.player_directions)
-
-        if (self.cycle1.check_collision(self.cycle2.trail, self.screen_width, self.screen_height) or
-                self.cycle2.check_collision(self.cycle1.trail, self.screen_width, self.screen_height)):
-            if self.collision_sound:
-                self.collision_sound.play()
-            self.game_over = True
-            if not self.cycle1.alive and not self.cycle2.alive:
-                self.winner = "Draw"
-            elif not self.cycle1.alive:
-                self.winner = self.cycle2.player_name
+            diff_label = self.text.render("AI Difficulty")
+            surface.blit(
+                diff_label,
+                (self.screen_width // 2 + 50 - diff_label.get_width() // 2, self.screen_height // 2 - 150))
+
+        for i, color in enumerate(self.color_options):
+            pygame.draw.rect(
+                surface, color,
+                (self.screen_width // 4 - 50, self.screen_height // 2 - 50 + i * 60, 100, 50))
+            pygame.draw.rect(
+                surface, color,
+                (3 * self.screen_width // 4 - 50, self.screen_height // 2 - 50 + i * 60, 100, 50))
+
+        for i, speed in enumerate(self.speed_options):
+            speed_text = self.text.render(str(speed))
+            surface.blit(
+                speed_text,
+                (self.screen_width // 2 - 100 + 50 - speed_text.get_width() // 2,
+                 self.screen_height // 2 - 50 + i * 60 + 10))
+
+        if self.single_player:
+            for i, difficulty in enumerate(self.difficulty_options):
+                diff_text = self.text.render(difficulty.capitalize())
+                surface.blit(
+                    diff_text,
+                    (self.screen_width // 2 + 50 + 50 - diff_text.get_width() // 2,
+                     self.screen_height // 2 - 50 + i * 60 + 10))
+
+        exit_text = self.text.render("Exit Settings")
+        surface.blit(
+            exit_text,
+            (self.screen_width // 2 - exit_text.get_width() // 2, self.screen_height - 140))
+
+    def repaint_arena(self, rect):
+        # restores the arena under rect: background, border and trails
+        self.screen.blit(self.static_screen("arena"), rect, rect)
+        self.screen.blit(self.trail_layer.surface, rect, rect)
+
+    def play_overlays(self):
+        # everything drawn on top of the arena, as ("head", color, last position, head position),
+        # ("text", text, position) or ("scrub", bar rect, filled width); heads are placed alpha
+        # of the way through their latest move
+        overlays = []
+        for cycle in self.sim.cycles:
+            if cycle.alive:
+                head = (round(cycle.last_x + (cycle.x - cycle.last_x) * self.alpha),
+                        round(cycle.last_y + (cycle.y - cycle.last_y) * self.alpha))
+                overlays.append(("head", cycle.color, (cycle.last_x, cycle.last_y), head))
+        overlays.append(("text", "Menu", (self.screen_width - 140, 20)))
+        if self.replay and self.replay.ticks:
+            bar = self.scrub_rect.inflate(0, -12)
+            overlays.append(("scrub", tuple(bar), bar.width * min(self.sim.tick / self.replay.ticks, 1)))
+
+        if self.countdown is not None:
+            elapsed = time() - self.countdown
+            if elapsed < 1:
+                text = "3"
+            elif elapsed < 2:
+                text = "2"
+            elif elapsed < 3:
+                text = "1"
+            elif elapsed < 4:
+                text = "GO!"
             else:
-                self.winner = self.cycle1.player_name
-            if self.victory_sound:
-                self.victory_sound.play()
+                self.countdown = None
+                text = None
+            if text:
+                width = self.text.render(text).get_width()
+                overlays.append(("text", text, (self.screen_width // 2 - width // 2, self.screen_height // 2)))
 
-    def draw(self):
-        self.screen.fill((0, 0, 0))
+        if self.game_over:
+            for text, y in ((f"Game Over! {self.winner} Wins!", self.screen_height // 2 - 50),
+                            ("Back to Home", self.screen_height // 2 + 50)):
+                width = self.text.render(text).get_width()
+                overlays.append(("text", text, (self.screen_width // 2 - width // 2, y)))
 
-        if self.state == "home":
-            title_text = self.font.render("Tron Light Cycle", True, (255, 255, 255))
-            single_text = self.font.render("Single Player", True, (255, 255, 255))
-            multi_text = self.font.render("Multiplayer", True, (255, 255, 255))
-
-            self.screen.blit(
-                title_text,
-                (self.screen_width // 2 - title_text.get_width() // 2, self.screen_height // 2 - 250))
-            self.screen.blit(
-                single_text,
-                (self.screen_width // 2 - single_text.get_width() // 2, self.screen_height // 2 - 90))
-            self.screen.blit(
-                multi_text,
-                (self.screen_width // 2 - multi_text.get_width() // 2, self.screen_height // 2 + 60))
-
-        elif self.state == "game":
-            pygame.draw.rect(
-                self.screen, (255, 0, 0),
-                (0, 0, self.screen_width, self.screen_height), 10)
-
-            if not self.in_settings and not self.paused:
-                self.cycle1.draw(self.screen)
-                self.cycle2.draw(self.screen)
-
-                settings_text = self.font.render("Menu", True, (255, 255, 255))
-                self.screen.blit(settings_text, (self.screen_width - 140, 20))
-
-                if self.countdown is not None:
-                    elapsed = time() - self.countdown
-                    if elapsed < 1:
-                        text = self.font.render("3", True, (255, 255, 255))
-                    elif elapsed < 2:
-                        text = self.font.render("2", True, (255, 255, 255))
-                    elif elapsed < 3:
-                        text = self.font.render("1", True, (255, 255, 255))
-                    elif elapsed < 4:
-                        text = self.font.render("GO!", True, (255, 255, 255))
-                    else:
-                        self.countdown = None
-                        text = None
-                    if text:
-                        self.screen.blit(
-                            text,
-                            (self.screen_width // 2 - text.get_width() // 2, self.screen_height // 2))
-
-                if self.game_over:
-                    game_over_text = self.font.render(
-                        f"Game Over! {self.winner} Wins!", True, (255, 255, 255))
-                    restart_text = self.font.render("Back to Home", True, (255, 255, 255))
-                    self.screen.blit(
-                        game_over_text,
-                        (self.screen_width // 2 - game_over_text.get_width() // 2,
-                         self.screen_height // 2 - 50))
-                    self.screen.blit(
-                        restart_text,
-                        (self.screen_width // 2 - restart_text.get_width() // 2,
-                         self.screen_height // 2 + 50))
-
-            elif self.paused:
-                pause_text = self.font.render("Paused", True, (255, 255, 255))
-                resume_text = self.font.render("Resume", True, (255, 255, 255))
-                restart_text = self.font.render("Restart", True, (255, 255, 255))
-                home_text = self.font.render("Back to Home", True, (255, 255, 255))
-
-                self.screen.blit(
-                    pause_text,
-                    (self.screen_width // 2 - pause_text.get_width() // 2, self.screen_height // 2 - 200))
-                self.screen.blit(
-                    resume_text,
-                    (self.screen_width // 2 - resume_text.get_width() // 2, self.screen_height // 2 - 90))
-                self.screen.blit(
-                    restart_text,
-                    (self.screen_width // 2 - restart_text.get_width() // 2, self.screen_height // 2 + 10))
-                self.screen.blit(
-                    home_text,
-                    (self.screen_width // 2 - home_text.get_width() // 2, self.screen_height // 2 + 110))
+        if self.show_profile:
+            overlays.append(self.profile_overlay())
+        return overlays
 
+    def profile_overlay(self):
+        # ("profile", lines, histogram bins), recomputed a few times a second rather than every
+        # frame, so the HUD does not repaint on every frame nor cost much itself
+        now = perf_counter()
+        if self.profile_hud is None or now - self.profile_hud_time >= PROFILE_HUD_REFRESH:
+            lines = [f"{len(self.profiler.order())} frames       p50     p95     p99 ms"]
+            for phase in ("frame",) + FrameProfiler.PHASES:
+                p50, p95, p99 = self.profiler.percentiles(None if phase == "frame" else phase)
+                lines.append(f"{phase:8} {p50:7.2f} {p95:7.2f} {p99:7.2f}")
+            self.profile_hud = ("profile", tuple(lines), tuple(self.profiler.histogram()))
+            self.profile_hud_time = now
+        return self.profile_hud
+
+    def draw_profile(self, lines, bins):
+        # a panel in the top left corner: the percentile table over a histogram of frame times,
+        # with the frame budget marked in red; returns its rect
+        panel = pygame.Rect(20, 20, 16 + 8 * PROFILE_HISTOGRAM_MS, 24 + 22 * len(lines) + 70)
+        pygame.draw.rect(self.screen, (20, 20, 20), panel)
+        y = panel.y + 8
+        if self.hud_text is None:
+            self.hud_text = TextCache(pygame.font.Font(None, 24))
+        for line in lines:
+            self.screen.blit(self.hud_text.render(line, (200, 200, 200)), (panel.x + 8, y))
+            y += 22
+        base = panel.bottom - 10
+        tallest = max(max(bins), 1)
+        for i, count in enumerate(bins):
+            height = round(60 * count / tallest)
+            if height:
+                pygame.draw.rect(self.screen, (0, 200, 255), (panel.x + 8 + 8 * i, base - height, 7, height))
+        if self.frame_rate:
+            budget = panel.x + 8 + round(8 * min(1000 / self.frame_rate, PROFILE_HISTOGRAM_MS))
+            pygame.draw.line(self.screen, (255, 60, 60), (budget, base - 62), (budget, base))
+        return panel
+
+    def draw_play(self):
+        # the arena stays on screen between frames: new trail segments are copied from the trail
+        # layer, the old overlays are painted over and only those rects are presented
+        full = self.presented != "play"
+        changed = self.trail_layer.update(self.sim.cycles)
+        overlays = self.play_overlays()
+        if not full and not changed and overlays == self.overlays:
+            return
+
+        if full:
+            self.repaint_arena(self.screen.get_rect())
+        else:
+            for rect in self.overlay_rects + changed:
+                self.repaint_arena(rect)
+
+        overlay_rects = []
+        for kind, *item in overlays:
+            if kind == "text":
+                text, position = item
+                overlay_rects.append(self.screen.blit(self.text.render(text), position))
+            elif kind == "head":
+                color, last, head = item
+                rect = pygame.draw.line(self.screen, color, last, head, 3)
+                overlay_rects.append(rect.union(pygame.draw.circle(self.screen, color, head, 5)))
+            elif kind == "scrub":
+                bar, filled = item
+                rect = pygame.draw.rect(self.screen, (90, 90, 90), bar, 1)
+                pygame.draw.rect(self.screen, (255, 255, 255), (bar[0], bar[1], round(filled), bar[3]))
+                overlay_rects.append(rect)
             else:
-                p1_label = self.font.render("Player 1 Colors", True, (255, 255, 255))
-                p2_label = self.font.render(
-                    f"{'AI' if self.single_player else 'Player 2'} Colors", True, (255, 255, 255))
-                speed_label = self.font.render("Speed", True, (255, 255, 255))
-                diff_label = self.font.render(
-                    "AI Difficulty", True, (255, 255, 255)) if self.single_player else self.font.render(
-                    "", True, (255, 255, 255))
-
-                self.screen.blit(
-                    p1_label,
-                    (self.screen_width // 4 - p1_label.get_width() // 2, self.screen_height // 2 - 150))
-                self.screen.blit(
-                    p2_label,
-                    (3 * self.screen_width // 4 - p2_label.get_width() // 2, self.screen_height // 2 - 150))
-                self.screen.blit(
-                    speed_label,
-                    (self.screen_width // 2 - 100 - speed_label.get_width() // 2, self.screen_height // 2 - 150))
-                self.screen.blit(
-                    diff_label,
-                    (self.screen_width // 2 + 50 - diff_label.get_width() // 2, self.screen_height // 2 - 150))
-
-                for i, color in enumerate(self.color_options):
-                    pygame.draw.rect(
-                        self.screen, color,
-                        (self.screen_width // 4 - 50, self.screen_height // 2 - 50 + i * 60, 100, 50))
-                    pygame.draw.rect(
-                        self.screen, color,
-                        (3 * self.screen_width // 4 - 50, self.screen_height // 2 - 50 + i * 60, 100, 50))
-
-                for i, speed in enumerate(self.speed_options):
-                    speed_text = self.font.render(str(speed), True, (255, 255, 255))
-                    self.screen.blit(
-                        speed_text,
-                        (self.screen_width // 2 - 100 + 50 - speed_text.get_width() // 2,
-                         self.screen_height // 2 - 50 + i * 60 + 10))
-
-                if self.single_player:
-                    for i, difficulty in enumerate(self.difficulty_options):
-                        diff_text = self.font.render(difficulty.capitalize(), True, (255, 255, 255))
-                        self.screen.blit(
-                            diff_text,
-                            (self.screen_width // 2 + 50 + 50 - diff_text.get_width() // 2,
-                             self.screen_height // 2 - 50 + i * 60 + 10))
+                overlay_rects.append(self.draw_profile(*item))
 
-                exit_text = self.font.render("Exit Settings", True, (255, 255, 255))
-                self.screen.blit(
-                    exit_text,
-                    (self.screen_width // 2 - exit_text.get_width() // 2, self.screen_height - 140))
+        if full:
+            pygame.display.flip()
+        else:
+            pygame.display.update(self.overlay_rects + changed + overlay_rects)
+        self.overlays = overlays
+        self.overlay_rects = overlay_rects
+        self.presented = "play"
 
-        pygame.display.flip()
+    def draw(self):
+        if self.state == "home":
+            name = "home"
+        elif self.paused:
+            name = "pause"
+        elif self.in_settings:
+            name = "settings"
+        else:
+            self.draw_play()
+            return
+
+        # static screens are only presented when they first appear
+        if self.presented != name:
+            self.screen.blit(self.static_screen(name), (0, 0))
+            pygame.display.flip()
+            self.presented = name
+
+    def running(self):
+        return (self.state == "game" and not self.game_over and not self.in_settings and
+                not self.paused and self.countdown is None)
 
     def run(self):
+        # the simulation advances in fixed ticks of 1 / tick_rate seconds however fast frames
+        # are drawn; after a long stall at most MAX_CATCH_UP_TICKS are run and the rest dropped
+        tick_time = 1 / self.tick_rate
+        accumulator = 0.0
+        previous = perf_counter()
         while True:
             self.handle_keyboard_input()
             self.handle_mouse_input()
-            self.update()
+            profiler = self.profiler
+            if profiler:
+                profiler.mark("input")
+
+            now = perf_counter()
+            accumulator += now - previous
+            previous = now
+            ticks = 0
+            while accumulator >= tick_time and ticks < MAX_CATCH_UP_TICKS:
+                self.update()
+                accumulator -= tick_time
+                ticks += 1
+            if ticks == MAX_CATCH_UP_TICKS:
+                accumulator = min(accumulator, tick_time)
+            if profiler:
+                profiler.mark("update")
+
+            self.alpha = accumulator / tick_time if self.running() else 1.0
             self.draw()
-            self.clock.tick(60)
+            if profiler:
+                profiler.mark("draw")
+            if self.startup:
+                self.startup.mark("first frame")
+                if self.startup_report:
+                    self.startup.report()
+                if self.startup_exit:
+                    self.quit(1 if self.startup.over_budget() else 0)
+                self.startup = None
+            self.clock.tick(self.frame_rate)
+            if profiler:
+                profiler.mark("idle")
+                profiler.next_frame()
 
 
 def main():
-    game = Game()
+    parser = argparse.ArgumentParser(description="Tron Light Cycle")
+    parser.add_argument("--ai-worker", action="store_true",
+                        help="run the expert AI in a separate process")
+    parser.add_argument("--tick-rate", type=int, default=TICK_RATE, help="simulation ticks per second")
+    parser.add_argument("--fps", type=int, default=60, help="frame rate cap, 0 for uncapped")
+    parser.add_argument("--cycles", type=int, default=2,
+                        help="cycles in the arena; seats past the first two are AIs")
+    parser.add_argument("--record", metavar="FILE", help="write a replay of each finished match to FILE")
+    parser.add_argument("--replay", metavar="FILE", help="watch a recorded match")
+    parser.add_argument("--fast-forward", action="store_true",
+                        help="with --replay, run the match headless and print how it ended")
+    parser.add_argument("--host", type=int, metavar="PORT", help="host a two-player netplay match on PORT")
+    parser.add_argument("--join", metavar="HOST:PORT", help="join a netplay match")
+    parser.add_argument("--rollback", action="store_true",
+                        help="with --host or --join, predict the peer's inputs and roll back when wrong")
+    parser.add_argument("--window", metavar="WIDTHxHEIGHT", help="play in a window instead of fullscreen")
+    parser.add_argument("--profile", action="store_true",
+                        help="time every frame from the start; F3 shows the timings, F4 saves a Chrome trace")
+    parser.add_argument("--profile-trace", metavar="FILE", help="profile, and save a Chrome trace to FILE on quit")
+    parser.add_argument("--memory-diagnostics", action="store_true",
+                        help="report allocations per tick, slow garbage collections and memory left after each match")
+    parser.add_argument("--startup-report", action="store_true",
+                        help="print how long each startup phase took once the first frame is on screen")
+    parser.add_argument("--startup-budget", type=float, metavar="MS",
+                        help="report startup against a budget for the time to the first frame")
+    parser.add_argument("--startup-exit", action="store_true",
+                        help="quit after the startup report, with exit status 1 when over --startup-budget")
+    parser.add_argument("--spectate", type=int, metavar="PORT",
+                        help="stream matches to spectators on PORT (watch with spectate.py watch HOST:PORT)")
+    args = parser.parse_args()
+    if args.record and args.replay:
+        parser.error("--record cannot be used with --replay")
+
+    replay = Replay.load(args.replay) if args.replay else None
+    if replay and args.fast_forward:
+        start = perf_counter()
+        sim = replay.fast_forward()
+        elapsed = perf_counter() - start
+        print(f"{sim.winner or 'No winner'} after {sim.tick} ticks "
+              f"({sim.tick / elapsed:,.0f} ticks/s)")
+        return
+
+    size = tuple(int(n) for n in args.window.lower().split("x")) if args.window else None
+    join = None
+    if args.join:
+        host, port = args.join.rsplit(":", 1)
+        join = (host, int(port))
+    game = Game(ai_worker=args.ai_worker, tick_rate=args.tick_rate, frame_rate=args.fps,
+                cycles=max(args.cycles, 2), record=args.record, replay=replay, host=args.host, join=join,
+                rollback=args.rollback, spectate_port=args.spectate, size=size, profile=args.profile,
+                profile_trace=args.profile_trace, memory_diagnostics=args.memory_diagnostics,
+                startup_report=args.startup_report, startup_budget=args.startup_budget,
+                startup_exit=args.startup_exit)
     game.run()
 
 
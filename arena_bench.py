@@ -0,0 +1,69 @@
+import argparse
+import os
+import time
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+import pygame
+
+from TRON import Simulation, TrailLayer
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+def run(screen, args, difficulty):
+    sim = Simulation(args.width, args.height, args.speed, [difficulty] * args.cycles)
+    seed = args.seed
+    sim.reset(seed)
+    layer = TrailLayer(screen.get_size())
+
+    frame_ms = []
+    matches = 0
+    for _ in range(args.frames):
+        start = time.perf_counter()
+        sim.step()
+        screen.fill((0, 0, 0))
+        layer.update(sim.cycles)
+        screen.blit(layer.surface, (0, 0))
+        for cycle in sim.cycles:
+            cycle.draw(screen)
+        pygame.display.flip()
+        frame_ms.append((time.perf_counter() - start) * 1000)
+        if sim.game_over:
+            matches += 1
+            seed += 1
+            sim.reset(seed)
+            layer = TrailLayer(screen.get_size())
+
+    budget = 1000 / args.fps
+    p99 = percentile(frame_ms, 0.99)
+    print(f"{args.cycles} {difficulty} cycles, {args.frames} frames, {matches} finished matches")
+    print(f"frame ms: mean {sum(frame_ms) / len(frame_ms):.2f}, p50 {percentile(frame_ms, 0.5):.2f}, "
+          f"p99 {p99:.2f}, max {max(frame_ms):.2f}")
+    print(f"{'holds' if p99 <= budget else 'misses'} {args.fps} FPS ({budget:.1f} ms budget at p99)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Frame time of an all-AI arena, simulation and drawing.")
+    parser.add_argument("--cycles", type=int, default=16)
+    parser.add_argument("--difficulty", nargs="+", default=["hard", "expert"],
+                        choices=["easy", "medium", "hard", "expert"], help="one run per difficulty")
+    parser.add_argument("--frames", type=int, default=3000)
+    parser.add_argument("--width", type=int, default=1920)
+    parser.add_argument("--height", type=int, default=1080)
+    parser.add_argument("--speed", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--fps", type=int, default=60, help="target frame rate")
+    args = parser.parse_args()
+
+    pygame.init()
+    screen = pygame.display.set_mode((args.width, args.height))
+    for difficulty in args.difficulty:
+        run(screen, args, difficulty)
+
+
+if __name__ == "__main__":
+    main()
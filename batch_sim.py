@@ -0,0 +1,176 @@
+import argparse
+import time
+
+import numpy as np
+
+from TRON import COLLISION_CELL, Direction
+
+
+DIRECTIONS = [Direction.UP, Direction.DOWN, Direction.LEFT, Direction.RIGHT]
+DX = np.array([d.value[0] for d in DIRECTIONS], dtype=np.int32)
+DY = np.array([d.value[1] for d in DIRECTIONS], dtype=np.int32)
+REVERSE = np.array([DIRECTIONS.index(Direction((-d.value[0], -d.value[1]))) for d in DIRECTIONS])
+DIFFICULTY_CODES = {"easy": 0, "medium": 1, "hard": 2}
+
+P1_WINS, P2_WINS, DRAW = 0, 1, 2
+
+
+class BatchSimulation:
+    # n two-cycle AI matches advanced in lockstep; mirrors Simulation.step, except that the
+    # AI's free runs are measured by a ray of at most ray_cells cells
+    def __init__(self, n, width=1920, height=1080, speed=10, difficulties=("medium", "medium"),
+                 seed=None, max_ticks=20000, ray_cells=64):
+        self.n = n
+        self.width = width
+        self.height = height
+        self.speed = speed
+        self.difficulties = np.array([DIFFICULTY_CODES[d] for d in difficulties])
+        self.max_ticks = max_ticks
+        self.ray_cells = max(ray_cells, 2 * speed)
+        self.cols = width // COLLISION_CELL + 1
+        self.rows = height // COLLISION_CELL + 1
+        self.grid = np.zeros((n, self.rows * self.cols), dtype=np.uint8)
+        self.x = np.zeros((n, 2), dtype=np.int32)
+        self.y = np.zeros((n, 2), dtype=np.int32)
+        self.dir = np.zeros((n, 2), dtype=np.int64)
+        self.alive = np.ones((n, 2), dtype=bool)
+        self.blocked = np.zeros((n, 2), dtype=bool)
+        self.ticks = np.zeros(n, dtype=np.int64)
+        self.rows_index = np.arange(n)[:, None]
+        self.grid_offsets = np.arange(n, dtype=np.int64)[:, None, None, None] * (self.rows * self.cols)
+        self.ray_deltas = np.array([-self.cols, self.cols, -1, 1])[:, None] * np.arange(1, self.ray_cells + 1)
+
+        self.path_steps = np.arange(speed // COLLISION_CELL + 2)
+        self.reset(seed)
+
+    def reset(self, seed=None):
+        self.rng = np.random.default_rng(seed)
+        self.wins = np.zeros(3, dtype=np.int64)
+        self.matches = 0
+        self.match_ticks = 0
+        self.cycle_ticks = 0
+        self.restart(np.ones(self.n, dtype=bool))
+
+    def restart(self, done):
+        self.grid[done] = 0
+        self.x[done] = (self.width // 4, 3 * self.width // 4)
+        self.y[done] = self.height // 2
+        self.dir[done] = (DIRECTIONS.index(Direction.RIGHT), DIRECTIONS.index(Direction.LEFT))
+        self.alive[done] = True
+        self.ticks[done] = 0
+
+    def cell_index(self, x, y):
+        return y // COLLISION_CELL * self.cols + x // COLLISION_CELL
+
+    def move(self):
+        prev_col = self.x // COLLISION_CELL
+        prev_row = self.y // COLLISION_CELL
+        self.x += DX[self.dir] * self.speed * self.alive
+        self.y += DY[self.dir] * self.speed * self.alive
+        col_delta = self.x // COLLISION_CELL - prev_col
+        row_delta = self.y // COLLISION_CELL - prev_row
+        length = np.abs(col_delta) + np.abs(row_delta)
+
+        steps = self.path_steps
+        cols = prev_col[..., None] + np.sign(col_delta)[..., None] * steps
+        rows = prev_row[..., None] + np.sign(row_delta)[..., None] * steps
+        inside = (cols >= 0) & (cols < self.cols) & (rows >= 0) & (rows < self.rows)
+        cells = np.where(inside, rows * self.cols + cols, 0)
+        matches = np.broadcast_to(self.rows_index[..., None], cols.shape)
+
+        # swept test as in LightCycle.check_collision: every cell crossed after the starting one
+        # must have been empty before this tick and not crossed or left by the other cycle
+        path = inside & (steps >= 1) & (steps <= length[..., None])
+        swept = inside & (steps <= length[..., None])
+        self.blocked = (path & (self.grid[matches, cells] != 0)).any(axis=-1)
+        mine = np.where(path, cells, -1)
+        theirs = np.where(swept, cells, -2)[:, ::-1]
+        self.blocked |= (mine[..., :, None] == theirs[..., None, :]).any(axis=(-2, -1))
+
+        mask = inside & (steps < length[..., None])
+        self.grid[matches[mask], cells[mask]] = 1
+
+    def ai_move(self):
+        # every cycle is AI controlled; candidates are scored for all four directions at once
+        candidate = np.ones(self.dir.shape + (4,), dtype=bool)
+        candidate[self.rows_index, np.arange(2), REVERSE[self.dir]] = False
+
+        # rays walk the flat grid; cells past the wall are cut off by the wall distance
+        head = self.cell_index(self.x, self.y)[..., None, None] + self.grid_offsets
+        cells = np.take(self.grid, head + self.ray_deltas, mode="clip")
+        walls = np.stack([(self.y - 10) // COLLISION_CELL, (self.height - 10 - self.y) // COLLISION_CELL,
+                          (self.x - 10) // COLLISION_CELL, (self.width - 10 - self.x) // COLLISION_CELL],
+                         axis=-1)
+        run = np.where(cells.any(axis=-1), cells.argmax(axis=-1), self.ray_cells)
+        run = np.minimum(run, np.maximum(walls, 0))
+        safe = candidate & (run * COLLISION_CELL >= self.speed * 10)
+        run = run * COLLISION_CELL // self.speed
+
+        any_safe = safe.any(axis=-1)
+        best = np.where(safe, run, -1).argmax(axis=-1)
+        random_safe = np.where(safe, self.rng.random(safe.shape), -1.0).argmax(axis=-1)
+        random_any = self.rng.integers(0, 4, size=self.dir.shape)
+        turn_easy = self.rng.random(self.dir.shape) < 0.3
+
+        difficulty = self.difficulties
+        choice = np.where(difficulty == 2, best, random_safe)
+        turn = any_safe & ((difficulty != 0) | turn_easy)
+        choice = np.where(turn, choice, self.dir)
+        choice = np.where(~any_safe & (difficulty != 0), random_any, choice)
+
+        allowed = self.alive & (choice != REVERSE[self.dir])
+        self.dir = np.where(allowed, choice, self.dir)
+
+    def check_collision(self):
+        wall = ((self.x < 10) | (self.x > self.width - 10) |
+                (self.y < 10) | (self.y > self.height - 10))
+        self.alive &= ~(wall | self.blocked)
+
+    def step(self):
+        self.move()
+        self.ai_move()
+        self.check_collision()
+        self.ticks += 1
+        self.cycle_ticks += 2 * self.n
+
+        done = ~self.alive.all(axis=1) | (self.ticks >= self.max_ticks)
+        if done.any():
+            alive = self.alive[done]
+            outcome = np.full(len(alive), DRAW)
+            outcome[alive[:, 0] & ~alive[:, 1]] = P1_WINS
+            outcome[alive[:, 1] & ~alive[:, 0]] = P2_WINS
+            self.wins += np.bincount(outcome, minlength=3)
+            self.matches += len(alive)
+            self.match_ticks += int(self.ticks[done].sum())
+            self.restart(done)
+        return int(done.sum())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run AI-vs-AI Tron matches in lockstep with NumPy.")
+    parser.add_argument("--matches", type=int, default=1024, help="concurrent matches")
+    parser.add_argument("--steps", type=int, default=2000)
+    parser.add_argument("--width", type=int, default=1920)
+    parser.add_argument("--height", type=int, default=1080)
+    parser.add_argument("--speed", type=int, default=10)
+    parser.add_argument("--p1", default="hard", choices=list(DIFFICULTY_CODES))
+    parser.add_argument("--p2", default="medium", choices=list(DIFFICULTY_CODES))
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    batch = BatchSimulation(args.matches, args.width, args.height, args.speed,
+                            (args.p1, args.p2), args.seed)
+    start = time.perf_counter()
+    for _ in range(args.steps):
+        batch.step()
+    elapsed = time.perf_counter() - start
+
+    print(f"{batch.cycle_ticks / elapsed:,.0f} cycle-ticks/s over {elapsed:.2f}s")
+    if batch.matches:
+        p1, p2, draws = batch.wins / batch.matches
+        print(f"{batch.matches} matches, avg {batch.match_ticks / batch.matches:.0f} ticks: "
+              f"P1 ({args.p1}) {p1:.1%}, P2 ({args.p2}) {p2:.1%}, draw {draws:.1%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,244 @@
+import argparse
+import json
+import os
+import platform
+import re
+import sys
+import time
+from array import array
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import pygame
+
+from TRON import Direction, Game, Simulation, TrailLayer
+
+
+RESOLUTIONS = {"1080p": (1920, 1080), "4k": (3840, 2160)}
+TRAIL_POINTS = [100, 1000, 10000, 100000]
+SPEEDS = [5, 10, 15, 20]
+DIFFICULTIES = ["easy", "medium", "hard", "expert"]
+SCREENS = ["home", "pause", "settings", "play", "game_over"]
+REPEATS = 5
+
+
+def build_arena(width, height, points):
+    # two hard AIs; the first has a trail of points corners, a staircase of 10 px steps bouncing
+    # around the left half of the arena that ends in a run to the middle, where it heads right.
+    # The second starts in the free right half, heading left
+    sim = Simulation(width, height, 10, ("hard", "hard"), seed=0)
+    cycle, rival = sim.cycles
+    x, y = 20, 20
+    dx = dy = 10
+    vertices = array("i", (x, y))
+    for i in range(points - 2):
+        if i % 2 == 0:
+            if not 20 <= x + dx <= width // 2 - 40:
+                dx = -dx
+            x += dx
+        else:
+            if not 20 <= y + dy <= height - 20:
+                dy = -dy
+            y += dy
+        vertices.extend((x, y))
+    head_x, head_y = width // 2, y
+    vertices.extend((head_x, head_y, head_x, head_y))
+    for i in range(0, len(vertices) - 2, 2):
+        sim.grid.mark_segment(*vertices[i:i + 4])
+    cycle.trail.vertices = vertices
+    cycle.x, cycle.y = cycle.last_x, cycle.last_y = head_x, head_y
+    cycle.last_vertex = len(cycle.trail) - 1
+    cycle.direction = Direction.RIGHT
+    rival.x = rival.last_x = 3 * width // 4
+    rival.y = rival.last_y = 3 * height // 4
+    rival.trail.vertices = array("i", (rival.x, rival.y, rival.x, rival.y))
+    return sim
+
+
+def set_speed(sim, speed):
+    sim.speed = speed
+    for cycle in sim.cycles:
+        cycle.speed = speed
+
+
+def measure(fn, min_time):
+    # per-call seconds over REPEATS batches, each batch long enough to time reliably
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        number *= 2 if elapsed <= 0 else max(2, min(int(min_time / elapsed * 1.2), 100))
+    samples = [elapsed / number]
+    for _ in range(REPEATS - 1):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        samples.append((time.perf_counter() - start) / number)
+    samples.sort()
+    return {"calls": number * REPEATS, "median_us": samples[len(samples) // 2] * 1e6,
+            "min_us": samples[0] * 1e6, "mean_us": sum(samples) / len(samples) * 1e6}
+
+
+def benchmarks(game, sim, start):
+    # (name, prepare, callable) triples; sim is restored to start before each is prepared
+    cycle, rival = sim.cycles
+    w, h = sim.width, sim.height
+
+    def check_collision():
+        rival.check_collision(w, h, [cycle])
+
+    def ai_move(difficulty):
+        def run():
+            direction = rival.direction
+            rival.ai_move([cycle], w, h, difficulty, cycle.player_directions, sim.rng)
+            rival.direction = direction
+        return run
+
+    safe = [Direction.UP, Direction.DOWN, Direction.LEFT]
+
+    def choose_best_direction():
+        rival.choose_best_direction(safe, cycle.player_directions)
+
+    def draw():
+        cycle.draw(game.screen)
+
+    def draw_trail():
+        cycle.draw_trail(game.screen)
+
+    def show(name):
+        def prepare():
+            game.state = "home" if name == "home" else "game"
+            game.paused = name == "pause"
+            game.in_settings = name == "settings"
+            if name == "game_over":
+                sim.game_over = True
+                sim.winner = "AI"
+        return prepare
+
+    def draw_screen():
+        game.presented = None
+        game.draw()
+
+    def tick():
+        if sim.game_over:
+            sim.restore(start)
+            game.trail_layer.clear()
+            game.presented = None
+        game.update()
+        game.draw()
+
+    def nothing():
+        pass
+
+    yield "LightCycle.check_collision", rival.move, check_collision
+    for difficulty in DIFFICULTIES:
+        yield f"LightCycle.ai_move[{difficulty}]", nothing, ai_move(difficulty)
+    yield "LightCycle.choose_best_direction", nothing, choose_best_direction
+    yield "LightCycle.draw", nothing, draw
+    yield "LightCycle.draw_trail", nothing, draw_trail
+    for name in SCREENS:
+        yield f"Game.draw[{name}]", show(name), draw_screen
+    yield "Game.update+draw", show("play"), tick
+
+
+def run(args):
+    pattern = re.compile(args.filter) if args.filter else None
+    resolutions = ["1080p"] if args.quick else list(RESOLUTIONS)
+    trails = [100, 10000] if args.quick else TRAIL_POINTS
+    speeds = [10] if args.quick else SPEEDS
+    results = []
+    for resolution in resolutions:
+        width, height = RESOLUTIONS[resolution]
+        game = Game(size=(width, height))
+        game.single_player = True
+        for points in trails:
+            sim = build_arena(width, height, points)
+            game.sim = sim
+            game.countdown = None
+            for speed in speeds:
+                set_speed(sim, speed)
+                start = sim.snapshot()
+                for name, prepare, fn in benchmarks(game, sim, start):
+                    if pattern and not pattern.search(name):
+                        continue
+                    sim.restore(start)
+                    game.trail_layer = TrailLayer(game.screen.get_size())
+                    game.presented = None
+                    prepare()
+                    params = {"resolution": resolution, "trail": points, "speed": speed}
+                    result = {"name": name, "params": params, **measure(fn, args.min_time)}
+                    results.append(result)
+                    print(f"{name:36} {resolution:>5} trail {points:>6} speed {speed:>2}  "
+                          f"{result['median_us']:10.1f} us", file=sys.stderr)
+                sim.restore(start)
+    report = {
+        "python": platform.python_version(),
+        "pygame": pygame.version.ver,
+        "platform": platform.platform(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=1)
+    print(f"{len(results)} results written to {args.output}", file=sys.stderr)
+
+
+def key(result):
+    params = result["params"]
+    return result["name"], params["resolution"], params["trail"], params["speed"]
+
+
+def compare(args):
+    # flags every benchmark whose median got slower by more than threshold; exit status 1 if any did
+    with open(args.baseline) as f:
+        baseline = {key(result): result for result in json.load(f)["results"]}
+    with open(args.current) as f:
+        current = {key(result): result for result in json.load(f)["results"]}
+    regressions = 0
+    for k in sorted(baseline.keys() & current.keys()):
+        old, new = baseline[k]["median_us"], current[k]["median_us"]
+        ratio = new / old if old else float("inf")
+        flag = ""
+        if ratio > 1 + args.threshold:
+            flag = "REGRESSION"
+            regressions += 1
+        elif ratio < 1 - args.threshold:
+            flag = "faster"
+        if flag or args.all:
+            name, resolution, points, speed = k
+            print(f"{name:36} {resolution:>5} trail {points:>6} speed {speed:>2}  "
+                  f"{old:10.1f} -> {new:10.1f} us  {ratio:5.2f}x  {flag}")
+    missing = len(baseline.keys() ^ current.keys())
+    print(f"{regressions} regressions beyond {args.threshold:.0%} in {len(baseline.keys() & current.keys())} "
+          f"benchmarks" + (f", {missing} not in both runs" if missing else ""))
+    return 1 if regressions else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmarks of the collision, AI, drawing and tick hot paths.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    command = commands.add_parser("run", help="run the benchmarks and write JSON results")
+    command.add_argument("--output", default="bench.json")
+    command.add_argument("--filter", help="only benchmarks whose name matches this regex")
+    command.add_argument("--quick", action="store_true", help="1080p, speed 10 and two trail lengths only")
+    command.add_argument("--min-time", type=float, default=0.02, help="seconds per timed batch")
+    command = commands.add_parser("compare", help="compare two JSON results")
+    command.add_argument("baseline")
+    command.add_argument("current")
+    command.add_argument("--threshold", type=float, default=0.10, help="slowdown flagged as a regression")
+    command.add_argument("--all", action="store_true", help="list unchanged benchmarks too")
+    args = parser.parse_args()
+
+    if args.command == "run":
+        run(args)
+    else:
+        sys.exit(compare(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,395 @@
+import argparse
+import heapq
+import random
+import socket
+import struct
+import time
+
+
+HELLO, START, INPUT = 1, 2, 3
+START_PACKET = struct.Struct("<BIHHBB")
+INPUT_HEADER = struct.Struct("<BIIB")
+CHECKSUM = struct.Struct("<IH")
+INPUT_DELAY = 6
+ROLLBACK_DELAY = 2
+MAX_PREDICTION = 15
+SEND_PERIOD = 0.05
+TIMEOUT = 5.0
+CHECKSUM_HISTORY = 256
+
+
+class LockstepSession:
+    # Two peers run the same deterministic Simulation and only exchange inputs: every tick each
+    # peer schedules its local input `delay` ticks ahead, and a tick is simulated once both
+    # inputs for it are known. Inputs are codes, 0 for no turn or 1 + a direction index.
+    #
+    # An INPUT packet carries every local input the peer has not acknowledged yet, so a lost
+    # packet is covered by the next one, plus an ack (the next remote tick still missing) and
+    # the 16-bit checksum of the sender's latest simulated tick for desync detection:
+    #   type, first tick, ack, count, count input codes packed two per byte, checksum tick, checksum
+    def __init__(self, sock, peer, seat, seed, width, height, speed, delay=INPUT_DELAY,
+                 send_period=SEND_PERIOD):
+        self.sock = sock
+        self.sock.setblocking(False)
+        self.peer = peer
+        self.seat = seat
+        self.seed = seed
+        self.width = width
+        self.height = height
+        self.speed = speed
+        self.delay = delay
+        self.send_period = send_period
+
+        self.local_inputs = {}
+        self.local_next = delay
+        self.local_pruned = delay
+        self.simulated = 0
+        self.remote_inputs = {}
+        self.remote_next = delay
+        self.peer_ack = delay
+        self.checksums = {}
+        self.remote_checksums = {}
+        self.latest_checksum = (0, 0)
+        self.desync_tick = None
+        # ticks simulated again by the latest advance; always 0 in lockstep
+        self.rollback_depth = 0
+
+        self.last_send = 0.0
+        self.last_receive = time.monotonic()
+        self.packets_sent = 0
+        self.bytes_sent = 0
+        # network simulator for testing: the fraction of outgoing packets dropped, and a delay
+        # of latency plus up to jitter seconds before each packet goes out
+        self.loss = 0.0
+        self.latency = 0.0
+        self.jitter = 0.0
+        self.outbox = []
+
+    @classmethod
+    def host(cls, port, seed, width, height, speed, delay=INPUT_DELAY, timeout=60.0, **kwargs):
+        # waits for a peer to say hello and sends it the match settings; the host is seat 0
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(("", port))
+        sock.settimeout(timeout)
+        while True:
+            data, peer = sock.recvfrom(64)
+            if data[:1] == bytes([HELLO]):
+                break
+        session = cls(sock, peer, 0, seed, width, height, speed, delay, **kwargs)
+        session.send_start()
+        return session
+
+    @classmethod
+    def join(cls, address, timeout=60.0, **kwargs):
+        # says hello until the host answers with the match settings; the joiner is seat 1
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.settimeout(0.2)
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            sock.sendto(bytes([HELLO]), address)
+            try:
+                data, peer = sock.recvfrom(64)
+            except socket.timeout:
+                continue
+            if data[:1] == bytes([START]):
+                _, seed, width, height, speed, delay = START_PACKET.unpack(data)
+                return cls(sock, peer, 1, seed, width, height, speed, delay, **kwargs)
+        raise TimeoutError(f"no answer from {address[0]}:{address[1]}")
+
+    def send_start(self):
+        self.sock.sendto(START_PACKET.pack(START, self.seed, self.width, self.height, self.speed, self.delay),
+                         self.peer)
+
+    def schedule(self, tick, code):
+        # records the local input for every tick up to tick + delay; returns True if the
+        # input was new, so a turn can be sent right away
+        scheduled = False
+        while self.local_next <= tick + self.delay:
+            self.local_inputs[self.local_next] = code
+            self.local_next += 1
+            code = 0
+            scheduled = True
+        return scheduled
+
+    def ready(self, tick):
+        return tick < self.delay or tick < self.remote_next
+
+    def inputs(self, tick):
+        # input codes by seat for tick; both are no-ops during the input delay
+        if tick < self.delay:
+            return [0, 0]
+        local, remote = self.local_inputs[tick], self.remote_inputs.pop(tick)
+        self.simulated = tick + 1
+        self.prune()
+        return [local, remote] if self.seat == 0 else [remote, local]
+
+    def advance(self, sim):
+        # simulates the next tick once both inputs for it are known; returns True if it did
+        if not self.ready(sim.tick):
+            return False
+        sim.step_codes(self.inputs(sim.tick))
+        self.record_checksum(sim.tick, sim.checksum())
+        return True
+
+    def settled(self, sim):
+        # whether sim holds no predicted ticks; a lockstep simulation never does
+        return True
+
+    def prune(self):
+        # local inputs stay until they are both simulated and acknowledged, as they may need resending
+        while self.local_pruned < min(self.peer_ack, self.simulated):
+            self.local_inputs.pop(self.local_pruned, None)
+            self.local_pruned += 1
+
+    def record_checksum(self, tick, checksum):
+        checksum &= 0xFFFF
+        self.checksums[tick] = checksum
+        self.checksums.pop(tick - CHECKSUM_HISTORY, None)
+        self.latest_checksum = (tick, checksum)
+        self.compare(tick)
+
+    def compare(self, tick):
+        if tick in self.checksums and tick in self.remote_checksums:
+            if self.checksums[tick] != self.remote_checksums.pop(tick) and self.desync_tick is None:
+                self.desync_tick = tick
+
+    def poll(self):
+        while True:
+            try:
+                data, peer = self.sock.recvfrom(2048)
+            except (BlockingIOError, InterruptedError):
+                return
+            except ConnectionResetError:
+                continue
+            if peer != self.peer or not data:
+                continue
+            self.last_receive = time.monotonic()
+            if data[0] == HELLO and self.seat == 0:
+                self.send_start()
+            elif data[0] == INPUT:
+                self.receive_inputs(data)
+
+    def receive_inputs(self, data):
+        _, first, ack, count = INPUT_HEADER.unpack_from(data)
+        offset = INPUT_HEADER.size
+        packed = data[offset:offset + (count + 1) // 2]
+        offset += len(packed)
+        for i in range(count):
+            tick = first + i
+            if tick >= self.remote_next:
+                self.remote_inputs[tick] = packed[i // 2] >> (4 * (i % 2)) & 0x0F
+        while self.remote_next in self.remote_inputs:
+            self.remote_next += 1
+        if ack > self.peer_ack:
+            self.peer_ack = ack
+            self.prune()
+        tick, checksum = CHECKSUM.unpack_from(data, offset)
+        if tick > max(self.checksums, default=-1) - CHECKSUM_HISTORY:
+            self.remote_checksums[tick] = checksum
+            self.compare(tick)
+
+    def send(self, force=False):
+        # sends unacknowledged inputs every send_period, or right away when forced
+        now = time.monotonic()
+        if not force and now - self.last_send < self.send_period:
+            return
+        self.last_send = now
+        first = self.peer_ack
+        count = min(max(self.local_next - first, 0), 255)
+        codes = [self.local_inputs.get(first + i, 0) for i in range(count)] + [0]
+        packed = bytes(codes[i] | codes[i + 1] << 4 for i in range(0, count, 2))
+        packet = (INPUT_HEADER.pack(INPUT, first, self.remote_next, count) + packed +
+                  CHECKSUM.pack(*self.latest_checksum))
+        self.packets_sent += 1
+        self.bytes_sent += len(packet)
+        if self.loss and random.random() < self.loss:
+            return
+        if self.latency or self.jitter:
+            due = now + self.latency + random.uniform(0, self.jitter)
+            heapq.heappush(self.outbox, (due, self.packets_sent, packet))
+            return
+        self.sock.sendto(packet, self.peer)
+
+    def flush(self):
+        # sends the delayed packets that are due; with jitter they may go out of order
+        now = time.monotonic()
+        while self.outbox and self.outbox[0][0] <= now:
+            self.sock.sendto(heapq.heappop(self.outbox)[2], self.peer)
+
+    def update(self, tick, code=0):
+        # once per game tick: read packets, schedule the local input and send what is due;
+        # returns True if code was scheduled, False if the simulation is stalled on the peer
+        self.flush()
+        self.poll()
+        scheduled = self.schedule(tick, code)
+        self.send(force=scheduled and code != 0)
+        return scheduled
+
+    @property
+    def timed_out(self):
+        return time.monotonic() - self.last_receive > TIMEOUT
+
+    def close(self):
+        self.sock.close()
+
+
+class RollbackSession(LockstepSession):
+    # Runs ahead of the peer instead of waiting for it: a tick whose remote input has not
+    # arrived is simulated with a predicted one, no turn, as the remote cycle mostly keeps its
+    # direction. Every tick starts with a Simulation.snapshot, so when an input arrives that
+    # differs from its prediction the simulation is restored to that tick and the ticks since
+    # are simulated again, all within the same frame. At most max_prediction ticks run ahead of
+    # the confirmed ones, the ticks before confirmed, whose inputs are all known.
+    #
+    # The packets are the lockstep ones; checksums are only exchanged for confirmed ticks.
+    def __init__(self, *args, max_prediction=MAX_PREDICTION, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.max_prediction = max_prediction
+        self.confirmed = 0
+        self.snapshots = {}
+        self.predicted_checksums = {}
+
+        # resimulation_ms is the cost of the latest advance's rollback; the rest are totals
+        self.resimulation_ms = 0.0
+        self.rollbacks = 0
+        self.max_rollback_depth = 0
+        self.resimulated_ticks = 0
+        self.resimulation_ms_total = 0.0
+        self.max_resimulation_ms = 0.0
+
+    def step(self, sim):
+        tick = sim.tick
+        self.snapshots[tick] = sim.snapshot()
+        local = self.local_inputs.get(tick, 0)
+        remote = self.remote_inputs.get(tick, 0) if tick < self.remote_next else 0
+        sim.step_codes([local, remote] if self.seat == 0 else [remote, local])
+        self.predicted_checksums[sim.tick] = sim.checksum()
+
+    def advance(self, sim):
+        # rolls back if a prediction was wrong, simulates the next tick unless too far ahead or
+        # the match is over, and confirms the ticks whose inputs have all arrived. Returns True
+        # if sim changed
+        self.rollback_depth = 0
+        self.resimulation_ms = 0.0
+        known = min(self.remote_next, sim.tick)
+        wrong = next((tick for tick in range(self.confirmed, known) if self.remote_inputs.get(tick, 0)), None)
+        if wrong is not None:
+            start = time.perf_counter()
+            end = sim.tick
+            sim.restore(self.snapshots[wrong])
+            for tick in range(wrong, end):
+                self.snapshots.pop(tick, None)
+                self.predicted_checksums.pop(tick + 1, None)
+            while sim.tick < end and not sim.game_over:
+                self.step(sim)
+            self.rollback_depth = end - wrong
+            self.resimulation_ms = (time.perf_counter() - start) * 1000
+            self.rollbacks += 1
+            self.max_rollback_depth = max(self.max_rollback_depth, self.rollback_depth)
+            self.resimulated_ticks += self.rollback_depth
+            self.resimulation_ms_total += self.resimulation_ms
+            self.max_resimulation_ms = max(self.max_resimulation_ms, self.resimulation_ms)
+
+        stepped = not sim.game_over and sim.tick - self.confirmed < self.max_prediction
+        if stepped:
+            self.step(sim)
+
+        confirmed = self.confirmed
+        while self.confirmed < min(self.remote_next, sim.tick):
+            self.snapshots.pop(self.confirmed)
+            self.remote_inputs.pop(self.confirmed, None)
+            self.confirmed += 1
+            self.record_checksum(self.confirmed, self.predicted_checksums.pop(self.confirmed))
+        sim.trim(self.snapshots[self.confirmed] if self.confirmed in self.snapshots else sim.snapshot())
+        self.simulated = self.confirmed
+        self.prune()
+        return stepped or wrong is not None or self.confirmed != confirmed
+
+    def settled(self, sim):
+        return self.confirmed == sim.tick
+
+
+def main():
+    # headless lockstep peer for testing on localhost, e.g.
+    #   python netplay.py host --port 5000        python netplay.py join 127.0.0.1:5000
+    from TRON import DIRECTION_CODES, TICK_RATE, Direction, Simulation
+
+    parser = argparse.ArgumentParser(description="Headless lockstep netplay peer driven by a simple bot.")
+    parser.add_argument("role", choices=["host", "join"])
+    parser.add_argument("address", nargs="?", default="127.0.0.1:5000", help="host:port to join")
+    parser.add_argument("--port", type=int, default=5000, help="port to host on")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--width", type=int, default=1920)
+    parser.add_argument("--height", type=int, default=1080)
+    parser.add_argument("--speed", type=int, default=10)
+    parser.add_argument("--delay", type=int, default=None,
+                        help=f"input delay in ticks, default {INPUT_DELAY} or {ROLLBACK_DELAY} with --rollback")
+    parser.add_argument("--tick-rate", type=int, default=TICK_RATE)
+    parser.add_argument("--rollback", action="store_true", help="predict the peer's inputs instead of waiting")
+    parser.add_argument("--loss", type=float, default=0.0, help="fraction of outgoing packets to drop")
+    parser.add_argument("--latency", type=float, default=0.0, help="ms added to every outgoing packet")
+    parser.add_argument("--jitter", type=float, default=0.0, help="up to this many more ms, at random")
+    parser.add_argument("--max-ticks", type=int, default=3600)
+    args = parser.parse_args()
+
+    session_class = RollbackSession if args.rollback else LockstepSession
+    if args.role == "host":
+        seed = args.seed if args.seed is not None else random.randrange(1 << 32)
+        delay = args.delay if args.delay is not None else ROLLBACK_DELAY if args.rollback else INPUT_DELAY
+        session = session_class.host(args.port, seed, args.width, args.height, args.speed, delay)
+    else:
+        host, port = args.address.rsplit(":", 1)
+        session = session_class.join((host, int(port)))
+    session.loss = args.loss
+    session.latency = args.latency / 1000
+    session.jitter = args.jitter / 1000
+    sim = Simulation(session.width, session.height, session.speed, (None, None), seed=session.seed)
+    session.record_checksum(0, sim.checksum())
+    bot = sim.cycles[session.seat]
+    rng = random.Random(session.seat)
+
+    tick_time = 1 / args.tick_rate
+    start = next_tick = time.monotonic()
+    stalls = 0
+    while not (sim.game_over and session.settled(sim)) and sim.tick < args.max_ticks and not session.timed_out:
+        # the bot steers for the longest free run, like the hard AI, or wanders, a few times a second
+        choice = bot.direction
+        if bot.alive and sim.tick % 10 == 0:
+            reverse = Direction((-bot.direction.value[0], -bot.direction.value[1]))
+            safe = [direction for direction in Direction if direction != reverse and
+                    bot.grid.free_run(bot.x, bot.y, direction) * bot.grid.cell >= bot.speed * 10]
+            if not safe:
+                choice = bot.choose_safe_direction()
+            elif rng.random() < 0.5:
+                choice = rng.choice(safe)
+            else:
+                choice = bot.choose_best_direction(safe, [])
+        code = 0 if choice == bot.direction else 1 + DIRECTION_CODES.index(choice)
+        session.update(sim.tick, code)
+        tick = sim.tick
+        session.advance(sim)
+        stalls += sim.tick == tick
+        next_tick += tick_time
+        time.sleep(max(next_tick - time.monotonic(), 0))
+    # keep answering for a moment so the peer can finish its last ticks
+    linger = time.monotonic() + 0.5
+    while time.monotonic() < linger:
+        session.update(sim.tick)
+        time.sleep(tick_time)
+    elapsed = time.monotonic() - start
+
+    print(f"seat {session.seat}: {sim.tick} ticks, winner {sim.winner or 'none'}, "
+          f"final checksum {sim.checksum():08x}, {stalls} stalled ticks")
+    print(f"{session.packets_sent} packets, {session.bytes_sent / elapsed:.0f} B/s payload, "
+          f"{(session.bytes_sent + 28 * session.packets_sent) / elapsed:.0f} B/s with UDP/IP headers")
+    if args.rollback:
+        print(f"{session.rollbacks} rollbacks, depth max {session.max_rollback_depth} "
+              f"mean {session.resimulated_ticks / max(session.rollbacks, 1):.1f} ticks, "
+              f"re-simulation max {session.max_resimulation_ms:.2f} ms "
+              f"mean {session.resimulation_ms_total / max(session.rollbacks, 1):.2f} ms per rollback")
+    print("desync at tick", session.desync_tick if session.desync_tick is not None else "none")
+    session.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+import argparse
+import os
+import random
+import sys
+import tempfile
+from itertools import compress
+
+from TRON import Direction, Replay, ReplayRecorder, Simulation
+
+
+def play(seed, width, height, difficulty, turns):
+    # a human seat that turns up to twice between ticks, as fast keypresses do, against an AI;
+    # returns the recorded replay and the checksum before every tick, once its turns are made
+    sim = Simulation(width, height, 10, (None, difficulty), seed=seed)
+    sim.recorder = ReplayRecorder(sim)
+    keys = random.Random(seed)
+    human = sim.cycles[0]
+    checksums = {}
+    while not sim.game_over:
+        room = [sim.grid.free_run(human.x, human.y, direction) * sim.grid.cell > 3 * sim.speed
+                for direction in Direction]
+        if keys.random() < turns or not room[list(Direction).index(human.direction)]:
+            # any first turn, then one that leaves the human room to live on
+            human.change_direction(keys.choice(list(Direction)))
+            human.change_direction(keys.choice(list(compress(Direction, room)) or list(Direction)))
+        checksums[sim.tick] = sim.checksum()
+        sim.step()
+    fd, path = tempfile.mkstemp(suffix=".tronreplay")
+    os.close(fd)
+    try:
+        sim.recorder.save(path)
+        replay = Replay.load(path)
+    finally:
+        os.remove(path)
+    return sim, replay, checksums
+
+
+def turned(replay, sim):
+    # sim with the recorded turns for its current tick made, as the match was before that tick
+    for cycle, action in zip(sim.cycles, replay.actions(sim)):
+        if action is not None:
+            cycle.change_direction(action)
+    return sim.checksum()
+
+
+def check(seed, args):
+    # the replay must agree with the match before every tick and end on the same checksum and
+    # winner, and seeking to every keyframe must agree too; returns a list of problems
+    sim, replay, checksums = play(seed, args.width, args.height, args.difficulty, args.turns)
+    problems = []
+    played = replay.simulation()
+    while not played.game_over and turned(replay, played) == checksums[played.tick]:
+        played.step()
+    if not played.game_over:
+        problems.append(f"replay diverges at tick {played.tick}")
+    elif (played.tick, played.checksum(), played.winner) != (sim.tick, sim.checksum(), sim.winner):
+        problems.append(f"replay ends at tick {played.tick} with {played.winner or 'no winner'}, "
+                        f"the match at tick {sim.tick} with {sim.winner or 'no winner'}")
+    seeker = replay.simulation()
+    for tick in reversed(replay.keyframe_ticks):
+        replay.seek(seeker, tick)
+        if turned(replay, seeker) != checksums[tick]:
+            problems.append(f"seeking to keyframe {tick} disagrees with the match")
+    return sim.tick, problems
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Check that recorded matches with fast double turns replay and seek exactly.")
+    parser.add_argument("--matches", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--width", type=int, default=1080)
+    parser.add_argument("--height", type=int, default=720)
+    parser.add_argument("--difficulty", default="hard", choices=["easy", "medium", "hard", "expert"])
+    parser.add_argument("--turns", type=float, default=0.1, help="chance the human turns before a tick")
+    args = parser.parse_args()
+
+    failures = 0
+    ticks = 0
+    for seed in range(args.seed, args.seed + args.matches):
+        length, problems = check(seed, args)
+        ticks += length
+        for problem in problems:
+            print(f"seed {seed}: {problem}")
+        failures += bool(problems)
+    print(f"{args.matches - failures} of {args.matches} matches ({ticks} ticks) replayed exactly")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,436 @@
+import argparse
+import asyncio
+import random
+import resource
+import socket
+import struct
+import threading
+import time
+from array import array
+from collections import deque
+
+
+# frames are length prefixed; a keyframe holds a whole match, a delta what changed in one tick
+#   keyframe: type, tick, width, height, cycle count, then per cycle color, alive, point count,
+#             name and points, then the winner
+#   delta:    type, tick, entry count, then per changed cycle seat, alive, new corner count and
+#             head, followed by the new corners, then the winner
+# points are int16 x, y pairs and texts a length byte and UTF-8, empty for none
+LENGTH = struct.Struct("<I")
+KEYFRAME, DELTA = 1, 2
+KEYFRAME_HEADER = struct.Struct("<BIHHB")
+KEYFRAME_CYCLE = struct.Struct("<3BBI")
+DELTA_HEADER = struct.Struct("<BIB")
+DELTA_ENTRY = struct.Struct("<BBHhh")
+QUEUE_SIZE = 64
+WRITE_BUFFER = 16 * 1024
+SOCKET_BUFFER = 32 * 1024
+
+
+def pack_text(text):
+    data = (text or "").encode()[:255]
+    return bytes([len(data)]) + data
+
+
+def unpack_text(data, offset):
+    length = data[offset]
+    return data[offset + 1:offset + 1 + length].decode() or None, offset + 1 + length
+
+
+class CycleView:
+    def __init__(self, name, color, alive, points):
+        self.name = name
+        self.color = color
+        self.alive = alive
+        # flat x, y pairs: the trail's corners followed by its head
+        self.points = points
+
+
+class MatchView:
+    # a spectator's copy of a match, just enough to draw it: set from a keyframe and kept
+    # current by deltas. The server keeps one too, to build keyframes for late joiners
+    def __init__(self):
+        self.tick = None
+        self.width = 0
+        self.height = 0
+        self.cycles = []
+        self.winner = None
+
+    @classmethod
+    def from_sim(cls, sim):
+        view = cls()
+        view.tick = sim.tick
+        view.width = sim.width
+        view.height = sim.height
+        view.cycles = [CycleView(cycle.player_name, tuple(cycle.color), cycle.alive, array("h", cycle.trail.vertices))
+                       for cycle in sim.cycles]
+        view.winner = sim.winner if sim.game_over else None
+        return view
+
+    def keyframe(self):
+        data = bytearray(KEYFRAME_HEADER.pack(KEYFRAME, self.tick, self.width, self.height, len(self.cycles)))
+        for cycle in self.cycles:
+            data += KEYFRAME_CYCLE.pack(*cycle.color, cycle.alive, len(cycle.points) // 2)
+            data += pack_text(cycle.name)
+            data += cycle.points.tobytes()
+        data += pack_text(self.winner)
+        return bytes(data)
+
+    def apply(self, payload):
+        if payload[0] == KEYFRAME:
+            _, self.tick, self.width, self.height, count = KEYFRAME_HEADER.unpack_from(payload)
+            offset = KEYFRAME_HEADER.size
+            self.cycles = []
+            for _ in range(count):
+                r, g, b, alive, length = KEYFRAME_CYCLE.unpack_from(payload, offset)
+                name, offset = unpack_text(payload, offset + KEYFRAME_CYCLE.size)
+                points = array("h", payload[offset:offset + 4 * length])
+                offset += 4 * length
+                self.cycles.append(CycleView(name, (r, g, b), bool(alive), points))
+        else:
+            _, self.tick, count = DELTA_HEADER.unpack_from(payload)
+            offset = DELTA_HEADER.size
+            for _ in range(count):
+                seat, alive, corners, x, y = DELTA_ENTRY.unpack_from(payload, offset)
+                offset += DELTA_ENTRY.size
+                cycle = self.cycles[seat]
+                del cycle.points[-2:]
+                cycle.points.frombytes(payload[offset:offset + 4 * corners])
+                offset += 4 * corners
+                cycle.points.extend((x, y))
+                cycle.alive = bool(alive)
+        self.winner, _ = unpack_text(payload, offset)
+
+
+class DeltaEncoder:
+    # turns a running Simulation into frames: a keyframe for a new match, or when a trail lost
+    # corners to a replay seek or a netplay rollback, otherwise only what changed since the last
+    # frame. Keeps a copy of the corners it has sent so a rewritten trail is noticed
+    def __init__(self):
+        self.grid = None
+        self.tick = None
+        self.winner = None
+        self.sent = []
+
+    def keyframe(self, sim):
+        self.grid = sim.grid
+        self.tick = sim.tick
+        self.winner = sim.winner if sim.game_over else None
+        self.sent = [(cycle.trail.vertices[:-2], tuple(cycle.trail.vertices[-2:]), cycle.alive)
+                     for cycle in sim.cycles]
+        return MatchView.from_sim(sim).keyframe()
+
+    def encode(self, sim):
+        # the frame to publish for sim's current state, or None when nothing changed
+        if sim.grid is not self.grid or sim.tick < self.tick or len(sim.cycles) != len(self.sent):
+            return self.keyframe(sim)
+        entries = bytearray()
+        count = 0
+        for seat, cycle in enumerate(sim.cycles):
+            corners, head, alive = self.sent[seat]
+            vertices = cycle.trail.vertices
+            sent = len(corners)
+            if len(vertices) - 2 < sent or vertices[:sent] != corners:
+                return self.keyframe(sim)
+            new = vertices[sent:-2]
+            current = tuple(vertices[-2:])
+            if new or current != head or cycle.alive != alive:
+                entries += DELTA_ENTRY.pack(seat, cycle.alive, len(new) // 2, *current)
+                entries += array("h", new).tobytes()
+                corners.extend(new)
+                self.sent[seat] = (corners, current, cycle.alive)
+                count += 1
+        winner = sim.winner if sim.game_over else None
+        if not count and sim.tick == self.tick and winner == self.winner:
+            return None
+        self.tick = sim.tick
+        self.winner = winner
+        return DELTA_HEADER.pack(DELTA, sim.tick, count) + bytes(entries) + pack_text(winner)
+
+
+class Spectator(asyncio.Protocol):
+    # one connection. Frames, shared by every spectator, are written straight to the socket;
+    # only while the transport's buffer is over WRITE_BUFFER are they queued, and when a slow
+    # reader lets the queue fill up the backlog is coalesced into one keyframe of the current state
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+        self.paused = False
+        self.queue = deque()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        transport.set_write_buffer_limits(WRITE_BUFFER)
+        transport.get_extra_info("socket").setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER)
+        self.server.join(self)
+
+    def connection_lost(self, exc):
+        self.server.clients.discard(self)
+
+    def data_received(self, data):
+        # spectators have nothing to say
+        pass
+
+    def pause_writing(self):
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+        while self.queue and not self.paused:
+            self.transport.write(self.queue.popleft())
+
+    def put(self, packet, keyframe):
+        # returns True if the backlog had to be coalesced
+        if not self.paused:
+            self.transport.write(packet)
+            return False
+        if len(self.queue) < self.server.queue_size:
+            self.queue.append(packet)
+            return False
+        self.queue.clear()
+        self.queue.append(keyframe())
+        return True
+
+
+class SpectatorServer:
+    # streams a match to any number of TCP spectators. publish encodes the simulation in the
+    # caller's thread; everything else runs on the server's asyncio loop, which may be another
+    # thread (start_thread) so the game loop never waits on a spectator
+    def __init__(self, queue_size=QUEUE_SIZE):
+        self.queue_size = queue_size
+        self.encoder = DeltaEncoder()
+        self.view = MatchView()
+        self.clients = set()
+        self.cached_keyframe = None
+        self.loop = None
+        self.server = None
+        self.frames = 0
+        self.coalesced = 0
+        self.peak_clients = 0
+
+    async def start(self, host, port):
+        self.loop = asyncio.get_running_loop()
+        self.server = await self.loop.create_server(lambda: Spectator(self), host, port, backlog=2048)
+
+    def start_thread(self, host, port):
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(self.start(host, port))
+        threading.Thread(target=loop.run_forever, daemon=True).start()
+
+    def publish(self, sim):
+        payload = self.encoder.encode(sim)
+        if payload is not None:
+            self.loop.call_soon_threadsafe(self.broadcast, payload)
+
+    def broadcast(self, payload):
+        self.view.apply(payload)
+        self.cached_keyframe = None
+        packet = LENGTH.pack(len(payload)) + payload
+        self.frames += 1
+        for client in self.clients:
+            self.coalesced += client.put(packet, self.keyframe)
+
+    def keyframe(self):
+        # built at most once per frame, however many spectators need it
+        if self.cached_keyframe is None:
+            payload = self.view.keyframe()
+            self.cached_keyframe = LENGTH.pack(len(payload)) + payload
+        return self.cached_keyframe
+
+    def join(self, client):
+        # a late joiner starts from a keyframe of the match so far
+        if self.view.tick is not None:
+            client.transport.write(self.keyframe())
+        self.clients.add(client)
+        self.peak_clients = max(self.peak_clients, len(self.clients))
+
+    def backlog(self):
+        # frames queued and bytes buffered for all spectators
+        return (sum(len(client.queue) for client in self.clients),
+                sum(client.transport.get_write_buffer_size() for client in self.clients))
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.server.close)
+
+
+async def read_frame(reader):
+    length, = LENGTH.unpack(await reader.readexactly(LENGTH.size))
+    return await reader.readexactly(length)
+
+
+async def run_matches(server, args, stop=None):
+    # all-AI matches back to back at the tick rate, each published after every tick
+    from TRON import Simulation
+
+    sim = Simulation(args.width, args.height, args.speed, [args.difficulty] * args.cycles)
+    seed = args.seed
+    sim.reset(seed)
+    tick_time = 1 / args.tick_rate
+    next_tick = time.monotonic()
+    while stop is None or not stop.is_set():
+        if sim.game_over:
+            await asyncio.sleep(args.pause)
+            seed += 1
+            sim.reset(seed)
+            next_tick = time.monotonic()
+        sim.step()
+        server.publish(sim)
+        next_tick += tick_time
+        await asyncio.sleep(max(next_tick - time.monotonic(), 0))
+    return sim
+
+
+async def serve(args):
+    server = SpectatorServer(args.queue_size)
+    await server.start("", args.port)
+    print(f"Streaming {args.cycles} {args.difficulty} cycles on port {args.port}")
+    await run_matches(server, args)
+
+
+async def watch(args):
+    # draws the match as frames arrive, scaled to the window
+    import pygame
+
+    host, port = args.address.rsplit(":", 1)
+    reader, writer = await asyncio.open_connection(host, int(port))
+    view = MatchView()
+    pygame.init()
+    screen = pygame.display.set_mode((args.window_width, args.window_height))
+    pygame.display.set_caption("Tron Light Cycle - spectating")
+    font = pygame.font.Font(None, 48)
+
+    async def receive():
+        while True:
+            view.apply(await read_frame(reader))
+
+    receiver = asyncio.create_task(receive())
+    while not receiver.done():
+        if any(event.type == pygame.QUIT for event in pygame.event.get()):
+            break
+        screen.fill((0, 0, 0))
+        if view.tick is not None:
+            scale = min(args.window_width / view.width, args.window_height / view.height)
+            for cycle in view.cycles:
+                points = [(cycle.points[i] * scale, cycle.points[i + 1] * scale)
+                          for i in range(0, len(cycle.points), 2)]
+                if len(points) > 1:
+                    pygame.draw.lines(screen, cycle.color, False, points, 2)
+                if cycle.alive:
+                    pygame.draw.circle(screen, cycle.color, points[-1], 4)
+            if view.winner:
+                text = font.render(f"{view.winner} Wins!", True, (255, 255, 255))
+                screen.blit(text, text.get_rect(center=(args.window_width // 2, args.window_height // 2)))
+        pygame.display.flip()
+        await asyncio.sleep(1 / 60)
+    receiver.cancel()
+    writer.close()
+    pygame.quit()
+
+
+async def bench(args):
+    # one process: the server, a running match and every spectator. Most spectators only read,
+    # a few decode and are checked against the simulation at the end, and some read too slowly
+    server = SpectatorServer(args.queue_size)
+    await server.start("127.0.0.1", 0)
+    port = server.server.sockets[0].getsockname()[1]
+    stop = asyncio.Event()
+    received = [0]
+
+    class Reader(asyncio.Protocol):
+        def data_received(self, data):
+            received[0] += 1
+
+    async def spectator(mode):
+        if mode == "read":
+            transport, _ = await asyncio.get_running_loop().create_connection(Reader, "127.0.0.1", port)
+            await stop.wait()
+            transport.close()
+            return None
+        sock = socket.socket()
+        if mode == "slow":
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        sock.setblocking(False)
+        await asyncio.get_running_loop().sock_connect(sock, ("127.0.0.1", port))
+        # a small limit, or the slow reader's StreamReader would buffer the backlog itself
+        reader, writer = await asyncio.open_connection(sock=sock, limit=1024 if mode == "slow" else 65536)
+        view = MatchView()
+        try:
+            while True:
+                if mode == "slow":
+                    await asyncio.sleep(1)
+                    if not await reader.read(256):
+                        break
+                else:
+                    view.apply(await read_frame(reader))
+                received[0] += 1
+        except (asyncio.CancelledError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        writer.close()
+        return view
+
+    modes = (["decode"] * args.verify + ["slow"] * int(args.clients * args.slow))
+    modes += ["read"] * (args.clients - len(modes))
+    random.Random(0).shuffle(modes)
+    tasks = []
+    for mode in modes:
+        tasks.append(asyncio.create_task(spectator(mode)))
+        await asyncio.sleep(0)
+    match = asyncio.create_task(run_matches(server, args, stop))
+
+    peak_frames = peak_bytes = 0
+    start = time.monotonic()
+    while time.monotonic() - start < args.seconds:
+        await asyncio.sleep(0.5)
+        frames, buffered = server.backlog()
+        peak_frames = max(peak_frames, frames)
+        peak_bytes = max(peak_bytes, buffered)
+    stop.set()
+    sim = await match
+    await asyncio.sleep(1)
+    for task in tasks:
+        task.cancel()
+    views = zip(modes, await asyncio.gather(*tasks))
+    expected = MatchView.from_sim(sim).keyframe()
+    verified = sum(view.keyframe() == expected for mode, view in views if mode == "decode")
+
+    print(f"{server.peak_clients} spectators ({modes.count('slow')} slow), {server.frames} frames in "
+          f"{args.seconds:.0f} s, {received[0] / args.seconds:,.0f} reads/s")
+    print(f"backlog peak: {peak_frames} queued frames, {peak_bytes / 1024:.0f} KiB buffered, "
+          f"{server.coalesced} backlogs coalesced to a keyframe")
+    print(f"max RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MiB, "
+          f"{verified}/{args.verify} decoding spectators match the simulation")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stream live matches to spectators over TCP.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    for name in ("serve", "bench"):
+        command = commands.add_parser(name)
+        command.add_argument("--cycles", type=int, default=4)
+        command.add_argument("--difficulty", default="hard", choices=["easy", "medium", "hard", "expert"])
+        command.add_argument("--width", type=int, default=1920)
+        command.add_argument("--height", type=int, default=1080)
+        command.add_argument("--speed", type=int, default=10)
+        command.add_argument("--seed", type=int, default=0)
+        command.add_argument("--tick-rate", type=int, default=60)
+        command.add_argument("--queue-size", type=int, default=QUEUE_SIZE, help="frames queued per spectator")
+        command.add_argument("--pause", type=float, default=2.0 if name == "serve" else 0.0,
+                             help="seconds the result stays up between matches")
+    commands.choices["serve"].add_argument("--port", type=int, default=5100)
+    commands.choices["bench"].add_argument("--clients", type=int, default=1000)
+    commands.choices["bench"].add_argument("--slow", type=float, default=0.1,
+                                           help="fraction of spectators that read too slowly")
+    commands.choices["bench"].add_argument("--verify", type=int, default=10,
+                                           help="spectators that decode every frame and are checked")
+    commands.choices["bench"].add_argument("--seconds", type=float, default=20)
+    command = commands.add_parser("watch")
+    command.add_argument("address", help="host:port of the server")
+    command.add_argument("--window-width", type=int, default=960)
+    command.add_argument("--window-height", type=int, default=540)
+    args = parser.parse_args()
+
+    asyncio.run({"serve": serve, "bench": bench, "watch": watch}[args.command](args))
+
+
+if __name__ == "__main__":
+    main()
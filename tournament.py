@@ -0,0 +1,122 @@
+import argparse
+import itertools
+import os
+import random
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from TRON import Direction, Simulation
+
+
+AI_PLAYERS = ["easy", "medium", "hard", "expert"]
+
+
+def straight_policy(cycle, rng):
+    return None
+
+
+def random_policy(cycle, rng):
+    if rng.random() < 0.1:
+        return rng.choice(list(Direction))
+    return None
+
+
+SCRIPTED_PLAYERS = {
+    "straight": straight_policy,
+    "random": random_policy
+}
+
+
+def play_match(p1, p2, seed, width, height, speed, max_ticks):
+    players = (p1, p2)
+    sim = Simulation(width, height, speed, [p if p in AI_PLAYERS else None for p in players], seed=seed)
+    rng = random.Random(seed)
+    policies = [SCRIPTED_PLAYERS.get(p) for p in players]
+    while not sim.game_over and sim.tick < max_ticks:
+        sim.step([policy(cycle, rng) if policy else None
+                  for policy, cycle in zip(policies, sim.cycles)])
+    alive = [cycle.alive for cycle in sim.cycles]
+    if alive == [True, False]:
+        winner = 0
+    elif alive == [False, True]:
+        winner = 1
+    else:
+        winner = None
+    return winner, sim.tick
+
+
+def play_batch(jobs, width, height, speed, max_ticks):
+    start = time.perf_counter()
+    results = [(p1, p2, seed) + play_match(p1, p2, seed, width, height, speed, max_ticks)
+               for p1, p2, seed in jobs]
+    return os.getpid(), time.perf_counter() - start, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Round-robin tournament between Tron AIs.")
+    parser.add_argument("--players", nargs="+", default=AI_PLAYERS + list(SCRIPTED_PLAYERS),
+                        choices=AI_PLAYERS + list(SCRIPTED_PLAYERS))
+    parser.add_argument("--matches", type=int, default=50, help="matches per seating of each pair")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--chunk", type=int, default=25, help="matches per task sent to a worker")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--width", type=int, default=1920)
+    parser.add_argument("--height", type=int, default=1080)
+    parser.add_argument("--speed", type=int, default=10)
+    parser.add_argument("--max-ticks", type=int, default=20000, help="longer matches count as draws")
+    args = parser.parse_args()
+
+    jobs = []
+    for p1, p2 in itertools.permutations(args.players, 2):
+        for i in range(args.matches):
+            jobs.append((p1, p2, args.seed + len(jobs)))
+    chunks = [jobs[i:i + args.chunk] for i in range(0, len(jobs), args.chunk)]
+
+    pairings = defaultdict(lambda: [0, 0, 0, 0])
+    records = defaultdict(lambda: [0, 0])
+    workers = defaultdict(lambda: [0, 0.0])
+    done = 0
+    start = time.perf_counter()
+    with ProcessPoolExecutor(args.workers) as pool:
+        futures = [pool.submit(play_batch, chunk, args.width, args.height, args.speed, args.max_ticks)
+                   for chunk in chunks]
+        for future in as_completed(futures):
+            pid, busy, results = future.result()
+            workers[pid][0] += len(results)
+            workers[pid][1] += busy
+            for p1, p2, seed, winner, ticks in results:
+                pairing = pairings[(p1, p2)]
+                pairing[2 if winner is None else winner] += 1
+                pairing[3] += ticks
+                records[p1][1] += 1
+                records[p2][1] += 1
+                if winner is not None:
+                    records[(p1, p2)[winner]][0] += 1
+            done += len(results)
+            elapsed = time.perf_counter() - start
+            print(f"{done}/{len(jobs)} matches, {done / elapsed:.0f} matches/s", flush=True)
+    elapsed = time.perf_counter() - start
+
+    print()
+    print(f"{'pairing':<22}{'matches':>8}{'p1 win':>8}{'p2 win':>8}{'draw':>8}{'avg ticks':>11}")
+    for (p1, p2), (p1_wins, p2_wins, draws, ticks) in sorted(pairings.items()):
+        matches = p1_wins + p2_wins + draws
+        print(f"{p1 + ' vs ' + p2:<22}{matches:>8}{p1_wins / matches:>8.1%}{p2_wins / matches:>8.1%}"
+              f"{draws / matches:>8.1%}{ticks / matches:>11.0f}")
+
+    print()
+    print(f"{'player':<12}{'matches':>8}{'win rate':>10}")
+    for player, (wins, matches) in sorted(records.items(), key=lambda item: -item[1][0] / item[1][1]):
+        print(f"{player:<12}{matches:>8}{wins / matches:>10.1%}")
+
+    print()
+    print(f"{'worker':<12}{'matches':>8}{'busy s':>9}{'matches/s':>11}")
+    for pid, (matches, busy) in sorted(workers.items()):
+        print(f"{pid:<12}{matches:>8}{busy:>9.2f}{matches / busy:>11.1f}")
+    print(f"{len(jobs)} matches in {elapsed:.2f}s ({len(jobs) / elapsed:.1f} matches/s, "
+          f"{len(workers)} workers)")
+
+
+if __name__ == "__main__":
+    main()